@@ -0,0 +1,381 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import uuid
+import zlib
+from enums import ROp
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'movielens')
+
+
+def gossip_records(n, replicas=3):
+    '''
+    Generate n update log records like those sent in gossip, as a mixture of
+    rating and tag updates accepted by each replica manager in turn.
+    '''
+
+    records = []
+    prev = [0] * replicas
+    for i in range(n):
+        _id = i % replicas
+        ts = list(prev)
+        ts[_id] += 1
+        if random.random() < 0.8:
+            u_op = (ROp.ADD_RATING.value, random.randint(1, 610),
+                    'toy story', random.randint(1, 10) / 2)
+        else:
+            u_op = (ROp.ADD_TAG.value, random.randint(1, 610),
+                    'toy story', 'funny')
+        records.append((_id, tuple(ts), u_op, tuple(prev), str(uuid.uuid4())))
+        prev = ts
+
+    return records
+
+
+def bench_digest(n=100):
+    '''
+    Measure the bytes sent to find and exchange the rows in which two
+    replicas differ by n ratings, by comparing digest trees, against sending
+    every rating and tag.
+    '''
+
+    import csv
+    from Pyro4.util import get_serializer
+    from digest import (DigestTree, bucket_movies, differing_buckets,
+                        rating_hash, tag_hash)
+
+    serializer = get_serializer('serpent')
+    with open(os.path.join(DATA_DIR, 'ratings.csv'), newline='') as f:
+        ratings = list(csv.DictReader(f))
+    with open(os.path.join(DATA_DIR, 'tags.csv'), newline='') as f:
+        tags = list(csv.DictReader(f))
+
+    def tree(ratings):
+        digests = DigestTree()
+        for row in ratings:
+            digests.add(int(row['movieId']), rating_hash(row))
+        for row in tags:
+            digests.add(int(row['movieId']), tag_hash(row))
+        return digests
+
+    diverged = list(ratings)
+    for i in random.sample(range(len(ratings)), n):
+        diverged[i] = dict(ratings[i], rating=str(float(ratings[i]['rating'])
+                                                  % 5 + 0.5))
+    ours, theirs = tree(ratings), tree(diverged)
+
+    sent = [0, 0]   # calls, bytes
+
+    def remote(depth, parents):
+        digests = theirs.digests(depth, parents)
+        sent[0] += 1
+        sent[1] += len(serializer.dumps((depth, parents)))
+        sent[1] += len(serializer.dumps(digests))
+        return digests
+
+    t = time.perf_counter()
+    buckets = differing_buckets(ours.digests, remote)
+    compare = time.perf_counter() - t
+
+    movies = {m for bucket in buckets for m in bucket_movies(bucket)}
+    rows = [row for row in ratings + tags if int(row['movieId']) in movies]
+    size = len(serializer.dumps(rows))
+
+    print(f'Replicas differing by {n} of {len(ratings)} ratings')
+    print('method'.ljust(10), 'calls'.rjust(8), 'rows'.rjust(10),
+          'bytes'.rjust(12))
+    print('digests'.ljust(10), f'{sent[0]:8d}', ''.rjust(10),
+          f'{sent[1]:12d}')
+    print('buckets'.ljust(10), f'{len(buckets) > 0:8d}', f'{len(rows):10d}',
+          f'{2 * size:12d}')
+    print('full'.ljust(10), f'{1:8d}', f'{len(ratings) + len(tags):10d}',
+          f'{2 * len(serializer.dumps(ratings + tags)):12d}')
+    print(f'{len(buckets)} differing buckets found in {compare:.3f}s')
+
+
+def bench_gossip(n=1000):
+    '''
+    Compare the size and serialization cost of a gossip message of n records
+    sent as raw tuples and encoded with gossipcodec.
+    '''
+
+    from Pyro4.util import get_serializer
+    from gossipcodec import encode_gossip, decode_gossip
+
+    serializer = get_serializer('serpent')
+    records = gossip_records(n)
+    rounds = 20
+
+    def raw():
+        return serializer.dumps(records)
+
+    def encoded():
+        return serializer.dumps(encode_gossip(records))
+
+    payload = encoded()
+
+    def decode():
+        return decode_gossip(serializer.loads(payload))
+
+    assert decode() == records
+
+    print(f'Gossip message of {n} records ({rounds} rounds)')
+    print('format'.ljust(10), 'bytes/update'.rjust(14), 'us/update'.rjust(12))
+    for name, dump in [('raw', raw), ('encoded', encoded)]:
+        size = len(dump())
+        t = timeit.timeit(dump, number=rounds) / rounds
+        print(name.ljust(10), f'{size / n:14.1f}', f'{t / n * 1e6:12.2f}')
+
+    t = timeit.timeit(decode, number=rounds) / rounds
+    print('decode'.ljust(10), ''.rjust(14), f'{t / n * 1e6:12.2f}')
+
+
+def bench_vectorclock(n=10000, replicas=3):
+    '''
+    Time the vector clock operations used on every request and gossip
+    record, and compare n timestamps to a clock one at a time and as a batch.
+    '''
+
+    from vectorclock import VectorClock, FrozenVectorClock, covered
+
+    stamps = [tuple(random.randint(0, 100) for _ in range(replicas))
+              for _ in range(n)]
+    frozen = [FrozenVectorClock.fromiterable(ts) for ts in stamps]
+    a = VectorClock.fromiterable(stamps[0])
+    b = VectorClock.fromiterable([50] * replicas)
+    rounds = 100000
+
+    operations = [
+        ('increment', lambda: a.increment(0)),
+        ('merge', lambda: a.merge(b)),
+        ('<=', lambda: a <= b),
+        ('<', lambda: a < b),
+        ('==', lambda: a == b),
+        ('value', a.value),
+        ('fromiter', lambda: VectorClock.fromiterable(stamps[0])),
+        ('frozen', lambda: FrozenVectorClock.fromiterable(stamps[0])),
+        ('hash', lambda: hash(frozen[0]))
+    ]
+
+    print(f'Vector clocks of {replicas} entries ({rounds} rounds)')
+    print('operation'.ljust(10), 'ns/op'.rjust(10))
+    for name, operation in operations:
+        t = timeit.timeit(operation, number=rounds) / rounds
+        print(name.ljust(10), f'{t * 1e9:10.0f}')
+
+    def one_at_a_time():
+        return [ts <= b for ts in frozen]
+
+    def batch():
+        return covered(stamps, b)
+
+    assert one_at_a_time() == batch()
+
+    print(f'\nComparing {n} timestamps to a clock')
+    print('method'.ljust(10), 'ns/stamp'.rjust(10))
+    for name, compare in [('single', one_at_a_time), ('batch', batch)]:
+        t = timeit.timeit(compare, number=20) / 20
+        print(name.ljust(10), f'{t / n * 1e9:10.0f}')
+
+
+def bench_updatelog(n=2000):
+    '''
+    Compare merging a gossip message of n records, half of them already in
+    the log, into an update log of n records kept as a list, with a linear
+    membership test per record, and as an UpdateLog. Also time selecting the
+    records a peer which has received half of them is missing.
+    '''
+
+    from updatelog import UpdateLog
+    from vectorclock import FrozenVectorClock, VectorClock
+
+    records = [(_id, FrozenVectorClock.fromiterable(ts), u_op,
+                FrozenVectorClock.fromiterable(u_prev), u_id)
+               for _id, ts, u_op, u_prev, u_id in gossip_records(n * 3 // 2)]
+    logged, message = records[:n], records[n // 2:]
+    peer = VectorClock.fromiterable(records[n // 2][1].value())
+
+    def merge_list():
+        log = list(logged)
+        for record in message:
+            if record not in log:
+                log.append(record)
+        return log
+
+    def merge_indexed():
+        log = UpdateLog()
+        for record in logged:
+            log.add(record)
+        for record in message:
+            if (record[4], record[0]) not in log:
+                log.add(record)
+        return log
+
+    log = merge_indexed()
+    assert len(merge_list()) == len(log)
+
+    print(f'Merging {len(message)} records into a log of {n}')
+    print('log'.ljust(10), 'us/record'.rjust(10))
+    for name, merge in [('list', merge_list), ('indexed', merge_indexed)]:
+        t = timeit.timeit(merge, number=3) / 3
+        print(name.ljust(10), f'{t / len(message) * 1e6:10.2f}')
+
+    missing = log.since(peer)
+    t = timeit.timeit(lambda: log.since(peer), number=20) / 20
+    print(f'\nSelecting {len(missing)} records missing from a peer: '
+          f'{t * 1e3:.2f}ms')
+
+
+def replica_manager_class():
+    '''
+    Import the ReplicaManager class, with the modules its main block imports
+    once it has changed to the replica's data folder.
+    '''
+
+    import replica_manager
+    replica_manager.import_modules()
+
+    return replica_manager.ReplicaManager
+
+
+def bench_recovery(n=10000):
+    '''
+    Time how long a replica manager takes to start up after a crash, with n
+    executed updates journaled in the write-ahead log since the last
+    snapshot, and after a clean shutdown, with the n updates in the update
+    log saved in the snapshot.
+    '''
+
+    from journal import WriteAheadLog
+
+    ReplicaManager = replica_manager_class()
+    records = gossip_records(n)
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as data:
+        os.chdir(data)
+        try:
+            for name in ['movies.csv', 'ratings.csv', 'tags.csv']:
+                shutil.copy(os.path.join(DATA_DIR, name), name)
+
+            # Journal the updates as a replica manager executing them would
+            wal = WriteAheadLog()
+            for _id, ts, u_op, u_prev, u_id in records:
+                wal.append({'op': 'log',
+                            'record': [_id, ts, u_op, u_prev, u_id]})
+                op, userId, _, value = u_op
+                row = {'userId': str(userId), 'movieId': '1',
+                       'timestamp': '964982703'}
+                if op == ROp.ADD_RATING.value:
+                    entry = {'op': 'rating',
+                             'row': dict(row, rating=str(float(value)))}
+                else:
+                    entry = {'op': 'tag', 'row': dict(row, tag=value)}
+                entry['update'] = {'u_id': u_id, 'ts': ts}
+                wal.append(entry)
+            wal.close()
+
+            print(f'Replica manager recovery with {n} updates')
+            print('start'.ljust(10), 'seconds'.rjust(10), 'log'.rjust(10))
+            for start in ['crash', 'clean']:
+                t = time.perf_counter()
+                rm = ReplicaManager(0, threading.Event(), 'active')
+                t = time.perf_counter() - t
+                print(start.ljust(10), f'{t:10.2f}',
+                      f'{len(rm.update_log):10d}')
+                assert len(rm.executed) == n and not len(rm.pending)
+
+                # Shut down cleanly, writing a snapshot of the state
+                rm.store.compact(rm.store_lock.reader, rm._save_state, True)
+                rm.store.wal.close()
+                rm.gossip_pool.shutdown()
+        finally:
+            os.chdir(cwd)
+
+
+def bench_transfer(n=10000):
+    '''
+    Compare a new replica manager catching up with one which has executed n
+    updates by receiving them all in gossip, and by fetching and installing
+    a snapshot with statetransfer, each including the time to start up.
+    '''
+
+    from contextlib import redirect_stdout
+    from gossipcodec import encode_gossip
+    from statetransfer import fetch_snapshot, install_snapshot
+
+    ReplicaManager = replica_manager_class()
+    records = gossip_records(n)
+    payload = encode_gossip(records)
+    m_ts = records[-1][1]
+    cwd = os.getcwd()
+
+    def start(folder, replica_id):
+        os.mkdir(folder)
+        os.chdir(folder)
+        for name in ['movies.csv', 'ratings.csv', 'tags.csv']:
+            shutil.copy(os.path.join(DATA_DIR, name), name)
+        return ReplicaManager(replica_id, threading.Event(), 'active')
+
+    def stop(rm):
+        rm.store.wal.close()
+        rm.gossip_pool.shutdown()
+
+    with tempfile.TemporaryDirectory() as data:
+        try:
+            # Replica manager which has executed the updates
+            source = start(os.path.join(data, 'source'), 0)
+            with redirect_stdout(None):
+                source.send_gossip(payload, m_ts, 1)
+
+            t = time.perf_counter()
+            rm = start(os.path.join(data, 'gossip'), 1)
+            with redirect_stdout(None):
+                rm.send_gossip(payload, m_ts, 0)
+            gossip = time.perf_counter() - t
+            assert rm.value_ts.value() == source.value_ts.value()
+            stop(rm)
+
+            t = time.perf_counter()
+            snapshot = fetch_snapshot(source)
+            os.mkdir(os.path.join(data, 'transfer'))
+            os.chdir(os.path.join(data, 'transfer'))
+            install_snapshot(snapshot)
+            rm = ReplicaManager(2, threading.Event(), 'active')
+            transfer = time.perf_counter() - t
+            assert rm.value_ts.value() == source.value_ts.value()
+            stop(rm)
+            stop(source)
+
+            print(f'Catching up on {n} updates')
+            print('method'.ljust(10), 'seconds'.rjust(10), 'bytes'.rjust(10))
+            print('gossip'.ljust(10), f'{gossip:10.2f}', f'{len(payload):10d}')
+            print('transfer'.ljust(10), f'{transfer:10.2f}',
+                  f'{len(zlib.compress(snapshot, 1)):10d}')
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    benchmarks = {
+        'digest': bench_digest,
+        'gossip': bench_gossip,
+        'recovery': bench_recovery,
+        'transfer': bench_transfer,
+        'updatelog': bench_updatelog,
+        'vectorclock': bench_vectorclock
+    }
+
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('Usage: python benchmark.py <benchmark> [args]')
+        print('Benchmarks:', ', '.join(benchmarks))
+        exit()
+
+    benchmarks[sys.argv[1]](*[int(a) for a in sys.argv[2:]])
@@ -0,0 +1,265 @@
+import heapq
+import threading
+import time
+from itertools import count
+
+
+class DependencyIndex:
+    '''
+    Index of items waiting for a vector timestamp to reach a required
+    timestamp. For every entry of an item's required timestamp that is not
+    yet satisfied, the item is placed in a min-heap for that entry. When the
+    timestamp advances only the heap tops that have become satisfied are
+    popped, so the work done is proportional to the dependencies resolved
+    rather than to the number of waiting items.
+    '''
+
+    def __init__(self):
+        self._waiting = {}  # key -> [unsatisfied entries, token]
+        self._heaps = {}    # entry index -> heap of (required, token, key)
+        self._tokens = count()
+
+    def __contains__(self, key):
+        return key in self._waiting
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def add(self, key, required, current):
+        '''
+        Add an item to the index, unless it is already satisfied.
+
+        Params:
+            key:              hashable identifier of the item
+            (tuple) required: timestamp the item is waiting for
+            (tuple) current:  current value of the timestamp
+
+        Returns:
+            (bool) whether the item is already satisfied
+        '''
+
+        # Entries beyond the end of a timestamp are 0
+        missing = [(i, r) for i, r in enumerate(required)
+                   if r > (current[i] if i < len(current) else 0)]
+        if not missing:
+            return True
+
+        token = next(self._tokens)
+        self._waiting[key] = [len(missing), token]
+        for i, r in missing:
+            heapq.heappush(self._heaps.setdefault(i, []), (r, token, key))
+
+        return False
+
+    def remove(self, key):
+        '''
+        Remove an item from the index. Its heap entries are discarded lazily.
+        '''
+
+        self._waiting.pop(key, None)
+
+    def advance(self, current):
+        '''
+        Resolve the dependencies satisfied by the current timestamp.
+
+        Params:
+            (tuple) current: current value of the timestamp
+
+        Returns:
+            ready: list of keys of the items that are now satisfied
+        '''
+
+        ready = []
+        for i, heap in self._heaps.items():
+            c = current[i] if i < len(current) else 0
+            while heap and heap[0][0] <= c:
+                _, token, key = heapq.heappop(heap)
+                waiting = self._waiting.get(key)
+                if waiting is None or waiting[1] != token:
+                    continue    # removed, or re-added since this entry
+                waiting[0] -= 1
+                if not waiting[0]:
+                    del self._waiting[key]
+                    ready.append(key)
+
+        return ready
+
+
+class PendingUpdates:
+    '''
+    Set of update log records that have not yet been executed, indexed by
+    their causal dependencies (the u_prev timestamp of each record). Stable
+    records are released in an order consistent with their timestamps.
+    '''
+
+    def __init__(self):
+        self.records = {}   # (u_id, _id) -> record
+        self._deps = DependencyIndex()
+        self._ready = []    # heap of (sum of ts, ts, key) of stable records
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record, value_ts):
+        '''
+        Add a record to the pending set.
+
+        Params:
+            (tuple) record:         update log record
+            (VectorClock) value_ts: current value timestamp of the replica
+        '''
+
+        _id, ts, u_op, u_prev, u_id = record
+        key = (u_id, _id)
+        if key in self.records:
+            return
+
+        self.records[key] = record
+        if self._deps.add(key, u_prev.value(), value_ts.value()):
+            self._push_ready(key)
+
+    def pop_stable(self, value_ts):
+        '''
+        Remove and return a record that is stable at the given value
+        timestamp.
+
+        Params:
+            (VectorClock) value_ts: current value timestamp of the replica
+
+        Returns:
+            record: a stable update log record, or None if there are none
+        '''
+
+        for key in self._deps.advance(value_ts.value()):
+            self._push_ready(key)
+
+        if not self._ready:
+            return None
+
+        *_, key = heapq.heappop(self._ready)
+        return self.records.pop(key)
+
+    def _push_ready(self, key):
+        # The sum of a timestamp's entries increases along every causal
+        # chain, so it orders stable records consistently with causality
+        ts = self.records[key][1].value()
+        heapq.heappush(self._ready, (sum(ts), ts, key))
+
+
+class Waiter:
+    '''
+    A query waiting for the value timestamp to reach its timestamp.
+    '''
+
+    def __init__(self, w_id, required, timeout):
+        self.id = w_id
+        self.required = required
+        self.deadline = time.monotonic() + timeout
+        self.event = threading.Event()  # set when the query becomes stable
+
+    def wait(self):
+        '''
+        Block until the query is stable or its deadline has passed.
+
+        Returns:
+            (bool) whether the query became stable
+        '''
+
+        return self.event.wait(max(self.deadline - time.monotonic(), 0))
+
+
+class WaitRegistry:
+    '''
+    Registry of queries waiting for the value timestamp to advance, indexed
+    by the timestamp each one needs. Each waiter has a unique ID, so that
+    identical concurrent queries are kept apart.
+    '''
+
+    def __init__(self):
+        self.waiters = {}   # waiter ID -> waiter
+        self._deps = DependencyIndex()
+        self._ids = count()
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def register(self, required, value_ts, timeout):
+        '''
+        Register a query to be woken when value_ts reaches required.
+
+        Params:
+            (VectorClock) required: timestamp the query needs
+            (VectorClock) value_ts: current value timestamp of the replica
+            (float) timeout:        seconds to wait before giving up
+
+        Returns:
+            waiter: the registered waiter
+        '''
+
+        waiter = Waiter(next(self._ids), required, timeout)
+        self.waiters[waiter.id] = waiter
+        if self._deps.add(waiter.id, required.value(), value_ts.value()):
+            self._wake(waiter.id)
+
+        return waiter
+
+    def advance(self, value_ts):
+        '''
+        Wake every waiter whose query is stable at value_ts.
+
+        Params:
+            (VectorClock) value_ts: current value timestamp of the replica
+        '''
+
+        for w_id in self._deps.advance(value_ts.value()):
+            self._wake(w_id)
+
+    def cancel(self, waiter):
+        '''
+        Remove a waiter whose deadline has passed.
+        '''
+
+        self._deps.remove(waiter.id)
+        self.waiters.pop(waiter.id, None)
+
+    def _wake(self, w_id):
+        self.waiters.pop(w_id).event.set()
+
+
+class UpdateExecutor(threading.Thread):
+    '''
+    Background thread that executes stable pending updates, so that a
+    replica manager can acknowledge an update as soon as it has been added
+    to the update log (write-behind) rather than once it has been applied.
+    '''
+
+    def __init__(self, execute, stopper):
+        super().__init__(daemon=True)
+
+        self.execute = execute  # executes the stable pending updates
+        self.stopper = stopper
+        self._event = threading.Event()     # set when there may be work
+
+    def notify(self):
+        '''
+        Wake the executor to execute any updates that have become stable.
+        '''
+
+        self._event.set()
+
+    def run(self):
+        '''
+        Override of threading.Thread run() method. Executes stable updates
+        whenever notified, until the stopper is set.
+        '''
+
+        while not self.stopper.is_set():
+            if self._event.wait(0.25):
+                self._event.clear()
+                self.execute()
+
+        self.execute()  # Apply updates acknowledged before stopping
+        print('Stopper set, update executor thread stopping.')
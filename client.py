@@ -1,6 +1,10 @@
+import csv
 import Pyro4
 from enums import ROp
 
+RATINGS_PAGE_SIZE = 50  # Number of ratings fetched per request
+IMPORT_BATCH_SIZE = 500     # Number of ratings imported per request
+
 
 def get_user_id():
     uid = input('Enter a user ID (number): ')
@@ -61,6 +65,40 @@ def get_rating():
     return rating
 
 
+def format_ratings(ratings):
+    response = ' Title'.ljust(50, ' ') + '| Rating\n'
+    response += '-' * 65 + '\n'
+    for row in ratings:
+        if len(row['title']) > 50:
+            response += row['title'][:48] + '- | '
+            response += row['rating'] + '\n -'
+            response += row['title'][48:].ljust(48, ' ')
+            response += '|\n'
+        else:
+            response += row['title'].ljust(50, ' ') + '| '
+            response += row['rating'] + '\n'
+
+    return response
+
+
+def format_movie_details(results):
+    (ok, movie), (stats_ok, stats), (tags_ok, tags) = results
+    if not ok:
+        return movie
+
+    response = (f'{movie["title"]}\n'
+                f'Genres: {", ".join(movie["genres"].split("|"))}\n')
+    if stats_ok and stats['count']:
+        response += (f'Average rating: {round(stats["mean"], 1)}/5 '
+                     f'({stats["count"]} ratings)\n')
+    elif stats_ok:
+        response += 'Not rated yet.\n'
+    if tags_ok:
+        response += f'Tags: {", ".join(tags) if tags else "none"}'
+
+    return response
+
+
 def format_search_result(result, search_var, search_val):
     if result:
         n = len(result)
@@ -88,10 +126,13 @@ class Client:
             ' 6. Get the tags for a movie',
             ' 7. Search movies by title',
             ' 8. Search movies by genre',
-            ' 9. Search movies by tag'
+            ' 9. Search movies by tag',
+            '10. Show all details of a movie',
+            '11. Import ratings from a CSV file'
         ]
 
         self.frontend = self._find_frontend()
+        self.session = None     # ID of our session with the front end
 
     def send_request(self, request):
         '''
@@ -106,6 +147,30 @@ class Client:
                     the response to the request by the front end.
         '''
 
+        return self._send('send_request', request)
+
+    def send_batch(self, requests):
+        '''
+        Send a batch of requests to the front end in a single call, handling
+        any errors which occur.
+
+        Params:
+            (list) requests: requests to send, each a command and args
+
+        Returns:
+            (bool) error: whether an error occurred sending the batch
+            result: if error, this is a string describing the error. Otherwise
+                    a list of (succeeded, result) for each request.
+        '''
+
+        return self._send('send_batch', requests)
+
+    def _send(self, method, arg):
+        '''
+        Call a front end method with our session, handling any errors which
+        occur.
+        '''
+
         result = None
         error = True
 
@@ -117,7 +182,10 @@ class Client:
 
         if self.frontend is not None:
             try:
-                result = self.frontend.send_request(request)
+                if self.session is None:
+                    self.session = self.frontend.open_session()
+                send = getattr(self.frontend, method)
+                result = send(arg, self.session)
                 error = False
             except Pyro4.errors.ConnectionClosedError:
                 self.frontend._pyroRelease()
@@ -130,6 +198,65 @@ class Client:
 
         return error, result
 
+    def close_session(self):
+        '''
+        End our session with the front end, if one is open.
+        '''
+
+        if self.frontend is not None and self.session is not None:
+            try:
+                self.frontend.close_session(self.session)
+            except Pyro4.errors.CommunicationError:
+                pass
+        self.session = None
+
+    def import_ratings(self, userId):
+        '''
+        Submit ratings read from a CSV file of movie titles and ratings, in
+        batches.
+
+        Params:
+            (int) userId: the id of the user submitting the ratings
+
+        Returns:
+            response: summary of the ratings submitted
+        '''
+
+        filename = input('Enter path of CSV file (title, rating): ')
+        try:
+            with open(filename, newline='') as csvfile:
+                rows = [row for row in csv.reader(csvfile) if len(row) >= 2]
+        except OSError as e:
+            return f'Could not read file [ {filename} ]: {e}'
+
+        requests = []
+        for title, rating, *_ in rows:
+            try:
+                rating = float(rating)
+            except ValueError:
+                continue    # e.g. a header row
+            requests.append((ROp.ADD_RATING.value, userId, title.lower(),
+                             round(rating * 2) / 2))
+
+        submitted = 0
+        failed = []
+        for i in range(0, len(requests), IMPORT_BATCH_SIZE):
+            batch = requests[i:i + IMPORT_BATCH_SIZE]
+            error, result = self.send_batch(batch)
+            if error:
+                return f'{result}\n\nSubmitted {submitted} ratings.'
+            for request, (ok, message) in zip(batch, result):
+                if ok:
+                    submitted += 1
+                else:
+                    failed.append(f'{request[2]}: {message}')
+
+        response = f'Submitted {submitted} ratings.'
+        if failed:
+            response += f'\n\n{len(failed)} ratings failed:\n'
+            response += '\n'.join(failed)
+        return response
+
     def print_menu(self):
         print()
         print(' --- Movie Database ---')
@@ -180,42 +307,47 @@ class Client:
                     response += f'You have tagged {title} with "{tag}"'
 
             elif choice == '3':
-                op = ROp.GET_AVG_RATING.value
+                op = ROp.GET_RATING_STATS.value
                 title = get_title()
                 request = (op, title)
                 error, result = self.send_request(request)
                 if error:
                     response = result
+                elif not result['count']:
+                    response = f'{title} has not been rated yet.'
                 else:
                     response = (f'Average rating for {title}: '
-                                f'{round(result, 1)}/5')
+                                f'{round(result["mean"], 1)}/5 '
+                                f'({result["count"]} ratings)\n')
+                    for rating, count in result['distribution'].items():
+                        response += f'\n{rating.rjust(4)} | {count}'
 
             elif choice == '4':
-                op = ROp.GET_RATINGS.value
+                op = ROp.GET_RATINGS_PAGE.value
                 title = None
                 print('Choose a movie you want to see your rating of,',
                       'or leave it blank to view all of your ratings.')
                 title = get_title()
-                request = (op, userId, title)
-                error, result = self.send_request(request)
-                if error:
-                    response = result
-                else:
-                    if result:
-                        response = ' Title'.ljust(50, ' ') + '| Rating\n'
-                        response += '-' * 65 + '\n'
-                        for row in result:
-                            if len(row['title']) > 50:
-                                response += row['title'][:48] + '- | '
-                                response += row['rating'] + '\n -'
-                                response += row['title'][48:].ljust(48, ' ')
-                                response += '|\n'
-                            else:
-                                response += row['title'].ljust(50, ' ') + '| '
-                                response += row['rating'] + '\n'
-
-                    else:
-                        response = 'You have submitted no ratings yet.'
+                offset = 0
+                while True:
+                    request = (op, userId, title, offset, RATINGS_PAGE_SIZE)
+                    error, result = self.send_request(request)
+                    if error:
+                        response = result
+                        break
+
+                    ratings, offset = result
+                    if offset is None:
+                        if ratings:
+                            response = format_ratings(ratings)
+                        else:
+                            response = 'You have submitted no ratings yet.'
+                        break
+
+                    print()
+                    print(format_ratings(ratings))
+                    print()
+                    input('Press ENTER to see more ratings.')
 
             elif choice == '5':
                 op = ROp.GET_GENRES.value
@@ -272,6 +404,21 @@ class Client:
                     response = format_search_result(result, 'tag', tag)
 
             elif choice == '10':
+                title = get_title()
+                requests = [(ROp.GET_MOVIE.value, title),
+                            (ROp.GET_RATING_STATS.value, title),
+                            (ROp.GET_TAGS.value, title)]
+                error, result = self.send_batch(requests)
+                if error:
+                    response = result
+                else:
+                    response = format_movie_details(result)
+
+            elif choice == '11':
+                response = self.import_ratings(userId)
+
+            elif choice == '12':
+                self.close_session()
                 print('Bye!')
                 break
 
@@ -314,6 +461,7 @@ if __name__ == '__main__':
         try:
             client.main()
         except KeyboardInterrupt:
+            client.close_session()
             print('\nCTRL+C pressed, exiting.')
     except Pyro4.errors.NamingError:
         print('Could not find Pyro nameserver, exiting.')
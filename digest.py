@@ -0,0 +1,105 @@
+from hashlib import blake2b
+
+
+BUCKET_WIDTH = 16   # movieIds in each bucket
+FANOUT = 16     # children of each node of the digest tree
+DEPTH = 5   # depth of the root, which covers movieIds below 16 * 16**5
+MASK = 2**64 - 1
+
+
+class DigestTree:
+    '''
+    Hierarchical digests of a replica's ratings and tags, for finding the
+    rows in which two replicas differ without sending the rows themselves.
+
+    Rows are bucketed by movieId range, and the digest of a bucket is the
+    sum, modulo 2**64, of the hashes of its rows. It is updated in constant
+    time as rows are added and removed, and is the same whatever order they
+    were added in. The digest of a node at depth d covers the buckets at
+    depth 0 below it, FANOUT**d of them, and is the sum of their digests.
+    Only buckets holding rows are kept, and nodes above them are summed
+    when asked for.
+    '''
+
+    def __init__(self):
+        self.buckets = {}   # bucket -> digest
+
+    def add(self, movieId, row_hash):
+        self._update(movieId // BUCKET_WIDTH, row_hash)
+
+    def remove(self, movieId, row_hash):
+        self._update(movieId // BUCKET_WIDTH, -row_hash)
+
+    def digests(self, depth, parents=None):
+        '''
+        Get the digests of the nodes at a depth of the tree.
+
+        Params:
+            (int) depth:    depth of the nodes, 0 for buckets
+            (list) parents: nodes at depth + 1 to get the children of, or
+                            None for every node
+
+        Returns:
+            digests: node -> digest, for nodes with rows below them
+        '''
+
+        span = FANOUT**depth
+        parents = None if parents is None else set(parents)
+        digests = {}
+        for bucket, digest in self.buckets.items():
+            node = bucket // span
+            if parents is None or node // FANOUT in parents:
+                digests[node] = (digests.get(node, 0) + digest) & MASK
+        return {node: digest for node, digest in digests.items() if digest}
+
+    def _update(self, bucket, row_hash):
+        digest = (self.buckets.get(bucket, 0) + row_hash) & MASK
+        if digest:
+            self.buckets[bucket] = digest
+        else:
+            del self.buckets[bucket]
+
+
+def differing_buckets(ours, theirs):
+    '''
+    Find the buckets in which two digest trees differ, starting from the
+    root and only descending into nodes whose digests differ. Trees which
+    are the same are compared with one call at each end.
+
+    Params:
+        (function) ours:   returns the digests of the local tree, given a
+                           depth and parents as for DigestTree.digests
+        (function) theirs: returns the digests of the remote tree
+
+    Returns:
+        buckets: list of buckets whose digests differ
+    '''
+
+    parents = None
+    for depth in range(DEPTH, -1, -1):
+        local, remote = ours(depth, parents), theirs(depth, parents)
+        parents = sorted(node for node in set(local) | set(remote)
+                         if local.get(node) != remote.get(node))
+        if not parents:
+            break
+    return parents
+
+
+def rating_hash(row):
+    return _hash('r', int(row['userId']), int(row['movieId']),
+                 float(row['rating']))
+
+
+def tag_hash(row):
+    return _hash('t', int(row['userId']), int(row['movieId']), row['tag'])
+
+
+def bucket_movies(bucket):
+    return range(bucket * BUCKET_WIDTH, (bucket + 1) * BUCKET_WIDTH)
+
+
+def _hash(*fields):
+    # Rows are hashed without their timestamps, which are set by each
+    # replica when it executes the update
+    data = '\x1f'.join(map(str, fields)).encode()
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), 'little')
@@ -17,7 +17,9 @@ class ROp(Enum):
     ADD_TAG = 'u.add_tag'
     GET_MOVIE = 'q.get_movie'
     GET_RATINGS = 'q.get_ratings'
+    GET_RATINGS_PAGE = 'q.get_ratings_page'
     GET_AVG_RATING = 'q.get_avg_rating'
+    GET_RATING_STATS = 'q.get_rating_stats'
     GET_GENRES = 'q.get_genres'
     GET_TAGS = 'q.get_tags'
     SEARCH_TITLE = 'q.search_title'
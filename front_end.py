@@ -1,15 +1,111 @@
 import Pyro4
-import random
 import signal
 import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
 from vectorclock import VectorClock
-from enums import Status, RType
+from enums import RType, ROp
 from signalhandler import SignalHandler
-from sys import platform
+from querycache import QueryCache
+from replica_monitor import ReplicaMonitor
+from routing import POLICIES, DEFAULT_POLICY
+from os import environ
+from sys import argv, platform
+
+REPLICA_NUM = int(environ.get('REPLICA_NUM', 3))   # initial number of replicas
+READ_CACHE_BYTES = 8 * 2**20    # Memory limit of the front end read cache
+FRESH_FOR = 1.0     # Seconds a cached result is served without revalidation
+REQUEST_TIMEOUT = 15.0  # Seconds to wait for a replica manager to respond
+SESSION_TIMEOUT = 3600.0    # Seconds an unused session is kept for
+DEFAULT_SESSION = 'default'     # Session of requests sent without one
+WRITE_BEHIND = True     # Whether replica managers acknowledge updates once
+                        # they are logged, rather than once executed
+PIPELINE_DEPTH = 1000   # Most updates queued by a pipelined session
+PIPELINE_BATCH = 200    # Most queued updates sent in one call
+PIPELINE_WORKERS = 8    # Threads sending the updates of pipelined sessions
+PROXY_POOL_SIZE = 4     # Idle connections kept open to each replica manager
+
+# Queries on the movie catalog, which is never updated, so their cached
+# results never need revalidating with a replica manager
+CATALOG_OPS = {ROp.GET_MOVIE.value, ROp.GET_GENRES.value,
+               ROp.SEARCH_TITLE.value, ROp.SEARCH_GENRE.value}
+
+
+class Session:
+    '''
+    State of a client session: the vector timestamp of the updates and
+    query results the client has seen.
+    '''
+
+    def __init__(self, s_id, pipelined=False):
+        self.id = s_id
+        self.ts = VectorClock(REPLICA_NUM)  # Vector timestamp of session
+        self.last_used = time.monotonic()
+
+        # Updates of a pipelined session are queued and sent in the
+        # background, so that the client does not wait for each one
+        self.pipelined = pipelined
+        self.queue = []     # (request, update ID) of updates not yet sent
+        self.sending = False    # whether the queue is being sent
+        self.failed = []    # (request, error) of updates which failed
+        self.cond = threading.Condition()
+
+    def advance(self, rm_ts):
+        '''
+        Merge a timestamp returned by a replica manager into the session's.
+        The clock is updated in place, so requests of the session sent at
+        the same time merge their timestamps one at a time.
+        '''
+
+        with self.cond:
+            self.ts.merge(VectorClock.fromiterable(rm_ts))
+
+
+class ProxyPool:
+    '''
+    Proxies for the replica managers, shared by every session, so that
+    sessions do not wait on each other's remote calls. Each proxy holds a
+    connection, which ties up a worker thread of the replica manager's Pyro
+    server while it is open, so only a few idle proxies are kept for each
+    replica manager. A proxy is used by one request at a time.
+    '''
+
+    def __init__(self, size=PROXY_POOL_SIZE):
+        self.size = size
+        self._idle = {}     # replica manager URI -> list of idle proxies
+        self._lock = threading.Lock()
 
-REPLICA_NUM = 3
+    @contextmanager
+    def proxy(self, uri):
+        '''
+        Borrow a proxy for a replica manager for the duration of a with
+        block. A proxy whose call fails to communicate is not reused.
+        '''
+
+        with self._lock:
+            idle = self._idle.get(uri)
+            proxy = idle.pop() if idle else None
+        if proxy is None:
+            proxy = Pyro4.Proxy(uri)
+            proxy._pyroTimeout = REQUEST_TIMEOUT
+
+        broken = False
+        try:
+            yield proxy
+        except Pyro4.errors.CommunicationError:
+            broken = True
+            raise
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(uri, [])
+                if not broken and len(idle) < self.size:
+                    idle.append(proxy)
+                    proxy = None
+            if proxy is not None:
+                proxy._pyroRelease()
 
 
 @Pyro4.expose
@@ -18,24 +114,86 @@ class FrontEnd:
     Class for Front End Server within the distributed system.
     '''
 
-    def __init__(self):
-        self.servers = []
-        self.rm = None
+    def __init__(self, stopper, policy=DEFAULT_POLICY):
+        # Table of replica managers and their loads, kept up to date in the
+        # background so that requests only need one remote call
+        self.monitor = ReplicaMonitor(stopper, REPLICA_NUM, POLICIES[policy]())
+        self.monitor.start()
 
-        # Initial selection of replica manager to communicate with
-        try:
-            self.rm = self._choose_replica()
-        except ValueError as e:
-            print(e)
+        # Client sessions, each with its own vector timestamp. Requests sent
+        # without a session share the default one
+        self.sessions = {DEFAULT_SESSION: Session(DEFAULT_SESSION)}
+        self.session_lock = threading.Lock()
+        self.proxies = ProxyPool()  # connections to the replica managers
+
+        # Results of recent queries, as (value, rm_ts, time fetched)
+        self.cache = QueryCache(READ_CACHE_BYTES)
+
+        # Threads sending the queued updates of pipelined sessions
+        self.pipeline_pool = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS)
+
+    def open_session(self, pipelined=False):
+        '''
+        Method invoked by client to start a session.
+
+        Params:
+            (bool) pipelined: whether updates are queued and acknowledged
+                              straight away, then sent in the background.
+                              Queries wait for the queued updates to be sent,
+                              so they still see every update of the session.
+
+        Returns:
+            s_id: ID of the session, to send with each request
+        '''
+
+        s_id = str(uuid.uuid4())
+        with self.session_lock:
+            self._expire_sessions()
+            self.sessions[s_id] = Session(s_id, pipelined)
+        return s_id
+
+    def flush(self, s_id):
+        '''
+        Method invoked by client to wait until every queued update of a
+        pipelined session has been sent.
+
+        Params:
+            (string) s_id: ID of the session
+
+        Returns:
+            failed: list of (request, error) of the updates which have failed
+                    since the last flush
+        '''
+
+        session = self._get_session(s_id)
+        self._drain(session)
+        with session.cond:
+            failed, session.failed = session.failed, []
+        return failed
+
+    def close_session(self, s_id):
+        '''
+        Method invoked by client to end a session.
+
+        Params:
+            (string) s_id: ID of the session
+        '''
 
-        self.ts = VectorClock(REPLICA_NUM)  # Vector timestamp of front end
+        if s_id == DEFAULT_SESSION:
+            return
 
-    def send_request(self, request):
+        with self.session_lock:
+            session = self.sessions.pop(s_id, None)
+        if session is not None:
+            self._drain(session)
+
+    def send_request(self, request, s_id=DEFAULT_SESSION):
         '''
         Method invoked by client to send a request.
 
         Params:
             (tuple) request: command to execute and arguments for the command
+            (string) s_id:   ID of the client's session
 
         Returns:
             If the request is a query, return the results of the query,
@@ -43,75 +201,253 @@ class FrontEnd:
         '''
 
         r_type = self._request_type(request)
+        session = self._get_session(s_id)
 
-        # Find a replica manager to send request to if the original is
-        # unavailable
-        if self.rm is not None:
-            try:
-                rm_status = self.rm.get_status()
-                print(rm_status)
-                if rm_status == Status.OFFLINE.value:
-                    self.rm = self._choose_replica()
-            except Pyro4.errors.ConnectionClosedError:
-                self.rm = self._choose_replica()
-        else:
-            self.rm = self._choose_replica()
+        if r_type == RType.UPDATE and session.pipelined:
+            self._enqueue(session, request)
+            return 'Update submitted!'
+
+        # Queries must see the session's updates, so wait for them to be sent
+        self._drain(session)
+
+        if r_type == RType.QUERY:
+            found, val = self._get_cached(request, session)
+            if found:
+                return val
 
         if r_type == RType.UPDATE:
-            rm_ts = self.rm.send_update(
-                request,
-                self.ts.value(),
-                str(uuid.uuid4())
-            )
+            u_id = str(uuid.uuid4())
+            rm_ts, load = self._call(
+                session,
+                lambda rm: rm.send_update(request, session.ts.value(), u_id,
+                                          not WRITE_BEHIND),
+                update=True)
 
             print('Update sent: ', request)
 
-            self.ts.merge(VectorClock.fromiterable(rm_ts))
+            if rm_ts is not None:
+                session.advance(rm_ts)
 
-            print('Front end timestamp: ', self.ts.value())
+            print('Session timestamp: ', session.ts.value())
             return 'Update submitted!'
 
         elif r_type == RType.QUERY:
-            val, rm_ts = self.rm.send_query(request, self.ts.value())
+            val, rm_ts, load = self._call(
+                session, lambda rm: rm.send_query(request, session.ts.value()))
 
             print('Query sent: ', request)
 
-            self.ts.merge(VectorClock.fromiterable(rm_ts))
+            session.advance(rm_ts)
+            self.cache.put(tuple(request), (val, rm_ts, time.monotonic()),
+                           set())
 
-            print('Front end timestamp: ', self.ts.value())
+            print('Session timestamp: ', session.ts.value())
             return val
 
-    def _choose_replica(self):
+    def send_batch(self, requests, s_id=DEFAULT_SESSION):
         '''
-        Select a replica manager to communicate with.
+        Method invoked by client to send a batch of requests in a single
+        call. The requests are handled in order by one replica manager, each
+        causally following those before it.
 
-        Return:
-            Remote object for a replica manager
+        Params:
+            (list) requests: requests, each a command to execute and
+                             arguments for the command
+            (string) s_id:   ID of the client's session
+
+        Returns:
+            results: (succeeded, result) of each request, where result is the
+                     result of a query, a confirmation message for an update,
+                     or a description of the error if the request failed
         '''
 
-        for server in self.servers:
-            server._pyroRelease()
+        session = self._get_session(s_id)
+        self._drain(session)
 
-        self.servers = self._find_replicas()
+        batch = []
+        for request in requests:
+            r_type = self._request_type(request)
+            u_id = str(uuid.uuid4()) if r_type == RType.UPDATE else None
+            batch.append((request, u_id))
 
-        stat = {server: server.get_status() for server in self.servers}
-        available = []
-        num_offline = list(stat.values()).count(Status.OFFLINE.value)
-        num_active = list(stat.values()).count(Status.ACTIVE.value)
+        results, rm_ts, load = self._call(
+            session, lambda rm: rm.send_batch(batch, session.ts.value(),
+                                              not WRITE_BEHIND),
+            update=any(u_id is not None for request, u_id in batch))
 
-        if num_active > 0:
-            available = [k for k in stat.keys()
-                         if stat[k] == Status.ACTIVE.value]
-        elif num_offline == len(self.servers):
-            raise Exception('All servers offline')
-        else:
-            available = [k for k in stat.keys()
-                         if stat[k] != Status.OFFLINE.value]
+        print(f'Batch of {len(batch)} requests sent')
 
-        if not available:
-            return None
+        session.advance(rm_ts)
 
-        return random.choice(available)
+        print('Session timestamp: ', session.ts.value())
+        return [(ok, 'Update submitted!' if ok and u_id else result)
+                for (ok, result), (request, u_id) in zip(results, batch)]
+
+    def _enqueue(self, session, request):
+        '''
+        Queue an update of a pipelined session, and start sending the queue
+        if it is not already being sent. Blocks while the queue is full.
+        '''
+
+        with session.cond:
+            while len(session.queue) >= PIPELINE_DEPTH:
+                session.cond.wait()
+
+            session.queue.append((request, str(uuid.uuid4())))
+            if not session.sending:
+                session.sending = True
+                self.pipeline_pool.submit(self._send_queue, session)
+
+    def _send_queue(self, session):
+        '''
+        Send the queued updates of a pipelined session in batches until the
+        queue is empty. The updates of each batch causally follow those of
+        the batch before, since each is sent with the session timestamp
+        returned for the last. Run in the pipeline thread pool.
+        '''
+
+        while True:
+            with session.cond:
+                batch = session.queue[:PIPELINE_BATCH]
+                del session.queue[:PIPELINE_BATCH]
+                if not batch:
+                    session.sending = False
+                    session.cond.notify_all()
+                    return
+                session.cond.notify_all()   # the queue has space again
+
+            try:
+                results, rm_ts, load = self._call(
+                    session, lambda rm: rm.send_batch(
+                        batch, session.ts.value(), not WRITE_BEHIND),
+                    update=True)
+                session.advance(rm_ts)
+                failed = [(request, result) for (request, u_id), (ok, result)
+                          in zip(batch, results) if not ok]
+            except Exception as e:
+                failed = [(request, str(e)) for request, u_id in batch]
+
+            print(f'Pipelined batch of {len(batch)} updates sent')
+            if failed:
+                with session.cond:
+                    session.failed += failed
+
+    def _drain(self, session):
+        '''
+        Wait until every queued update of a session has been sent.
+        '''
+
+        with session.cond:
+            while session.queue or session.sending:
+                session.cond.wait()
+
+    def _call(self, session, send, update=False):
+        '''
+        Send a request to the replica manager chosen by the routing policy,
+        retrying once if it cannot be reached or a query times out waiting
+        for updates. The load the replica manager returns with its response
+        is recorded in the replica table.
+
+        A query is retried on another replica manager. Updates are retried
+        on the same one, since they may have been logged before the error:
+        it recognises the update IDs and returns the original timestamps,
+        whereas another replica manager would log the updates again.
+
+        Params:
+            (Session) session: session the request belongs to
+            send:              function sending the request to a proxy
+            (bool) update:     whether the request includes updates
+
+        Returns:
+            response: response of the replica manager, ending with its load
+        '''
+
+        uri = self.monitor.choose(session.ts.value())
+        try:
+            with self.proxies.proxy(uri) as rm:
+                response = send(rm)
+        except (Pyro4.errors.CommunicationError, TimeoutError) as e:
+            print(e)
+            if not update:
+                if not isinstance(e, TimeoutError):
+                    self.monitor.report(uri, None)
+                uri = self.monitor.choose(session.ts.value(), exclude=uri)
+            with self.proxies.proxy(uri) as rm:
+                response = send(rm)
+
+        self.monitor.report(uri, response[-1])
+        return response
+
+    def _get_session(self, s_id):
+        '''
+        Find a session, starting it if it is not known (e.g. if the front end
+        has been restarted since the client opened it).
+        '''
+
+        with self.session_lock:
+            session = self.sessions.get(s_id)
+            if session is None:
+                session = self.sessions[s_id] = Session(s_id)
+            session.last_used = time.monotonic()
+        return session
+
+    def _expire_sessions(self):
+        '''
+        Close sessions which have not been used for SESSION_TIMEOUT seconds.
+        Must be called while holding session_lock.
+        '''
+
+        now = time.monotonic()
+        for s_id, session in list(self.sessions.items()):
+            if (s_id != DEFAULT_SESSION and
+                    now - session.last_used > SESSION_TIMEOUT):
+                del self.sessions[s_id]
+
+    def _get_cached(self, request, session):
+        '''
+        Look up the cached result of a query. A result is only served if it
+        reflects every update the session has seen, i.e. if the session
+        timestamp is at most the timestamp returned with the result. Results
+        of queries on the catalog are then always served, and others are
+        served for FRESH_FOR seconds after they were fetched or last
+        validated.
+
+        Params:
+            (tuple) request:   query to look up
+            (Session) session: session the query belongs to
+
+        Returns:
+            (bool) found: whether a valid cached result was found
+            val: the cached result, or None
+        '''
+
+        found, entry = self.cache.get(tuple(request))
+        if not found:
+            return False, None
+
+        val, rm_ts, fetched = entry
+        if not session.ts <= VectorClock.fromiterable(rm_ts):
+            return False, None
+
+        if request[0] in CATALOG_OPS or time.monotonic() - fetched < FRESH_FOR:
+            print('Query served from cache: ', request)
+            return True, val
+
+        # The result is still up to date if the replica manager the query
+        # would be sent to has not executed any updates since it was fetched
+        try:
+            uri = self.monitor.choose(session.ts.value())
+            with self.proxies.proxy(uri) as rm:
+                value_ts = rm.get_value_ts()
+        except Pyro4.errors.CommunicationError:
+            return False, None
+        if not VectorClock.fromiterable(value_ts) <= \
+                VectorClock.fromiterable(rm_ts):
+            return False, None
+
+        self.cache.put(tuple(request), (val, rm_ts, time.monotonic()), set())
+        print('Query served from validated cache: ', request)
+        return True, val
 
     @staticmethod
     def _request_type(request):
@@ -136,37 +472,27 @@ class FrontEnd:
 
         raise ValueError('command not recognised')
 
-    @staticmethod
-    def _find_replicas():
-        '''
-        Find all online replica managers.
-
-        Returns:
-            servers: list of remote server objects for replica managers
-        '''
-
-        servers = []
-        with Pyro4.locateNS() as ns:
-            for server, uri in ns.list(prefix="network.replica.").items():
-                print("found replica", server)
-                servers.append(Pyro4.Proxy(uri))
-        if not servers:
-            raise ValueError(
-                "No servers found! (are the movie servers running?)"
-            )
-        return servers[:REPLICA_NUM]
-
 
 if __name__ == '__main__':
     NAME = 'network.frontend'
 
+    POLICY = DEFAULT_POLICY
+
+    if len(argv) > 1:
+        POLICY = argv[1]
+        if POLICY not in POLICIES:
+            print(f'Unknown routing policy [ {POLICY} ], choose from:',
+                  ', '.join(POLICIES))
+            exit()
+
+    stopper = threading.Event()
     daemon = Pyro4.Daemon()
 
     try:
-        fe = FrontEnd()  # Create front end
+        fe = FrontEnd(stopper, POLICY)  # Create front end
 
         # Setup signal handler that will shut down our program gracefully
-        handler = SignalHandler(daemon=daemon)
+        handler = SignalHandler(stopper=stopper, daemon=daemon)
         signal.signal(signal.SIGINT, handler)
 
         # Register front end with Pyro daemon and nameserver
@@ -0,0 +1,101 @@
+import base64
+import json
+import zlib
+from enums import ROp
+
+
+VERSION = 1
+COMPRESS_THRESHOLD = 512    # compress encoded messages larger than this
+
+# Update commands are sent as these codes rather than as strings. The codes
+# are also saved in snapshots, so an op's code must never change, and new ops
+# must be given new codes
+OP_CODES = {
+    ROp.ADD_RATING.value: 0,
+    ROp.ADD_TAG.value: 1
+}
+OPS = {code: op for op, code in OP_CODES.items()}
+
+
+def encode_gossip(records):
+    '''
+    Encode update log records for a gossip message.
+
+    Every timestamp in the message is delta-encoded against a base clock,
+    the entrywise minimum of the u_prev timestamps of the records. Since an
+    update's ts differs from its u_prev only in the entry of the replica
+    manager that accepted it, ts is sent as a sparse list of its differences
+    from u_prev. The encoded message is zlib compressed if it is large.
+
+    Params:
+        records: list of (_id, ts, u_op, u_prev, u_id) records, with the
+                 timestamps as tuples
+
+    Returns:
+        (bytes) payload: encoded message
+    '''
+
+    # Timestamps grow as replica managers join, so they are padded with
+    # zeros to the same length
+    width = max((len(r[1]) for r in records), default=0)
+    if any(len(r[1]) != width or len(r[3]) != width for r in records):
+        records = [(_id, _pad(ts, width), u_op, _pad(u_prev, width), u_id)
+                   for _id, ts, u_op, u_prev, u_id in records]
+
+    base = [min(col) for col in zip(*(r[3] for r in records))]
+
+    encoded = []
+    for _id, ts, u_op, u_prev, u_id in records:
+        op, *params = u_op
+        prev = [p - b for p, b in zip(u_prev, base)]
+        ts_diff = [[i, t - p] for i, (t, p) in enumerate(zip(ts, u_prev))
+                   if t != p]
+        encoded.append([_id, ts_diff, OP_CODES[op], params, prev, u_id])
+
+    message = json.dumps({'v': VERSION, 'b': base, 'r': encoded},
+                         separators=(',', ':')).encode()
+
+    if len(message) > COMPRESS_THRESHOLD:
+        return b'z' + zlib.compress(message)
+    return b'j' + message
+
+
+def decode_gossip(payload):
+    '''
+    Decode the update log records of a gossip message.
+
+    Params:
+        payload: message encoded by encode_gossip
+
+    Returns:
+        records: list of (_id, ts, u_op, u_prev, u_id) records, with the
+                 timestamps as tuples
+    '''
+
+    # The serpent serializer used by Pyro transfers bytes as base64
+    if isinstance(payload, dict):
+        payload = base64.b64decode(payload['data'])
+
+    kind, message = payload[:1], payload[1:]
+    if kind == b'z':
+        message = zlib.decompress(message)
+    message = json.loads(message)
+
+    if message['v'] != VERSION:
+        raise ValueError(f'Unsupported gossip version [ {message["v"]} ].')
+
+    base = message['b']
+    records = []
+    for _id, ts_diff, code, params, prev, u_id in message['r']:
+        u_prev = [p + b for p, b in zip(prev, base)]
+        ts = list(u_prev)
+        for i, d in ts_diff:
+            ts[i] += d
+        u_op = (OPS[code], *params)
+        records.append((_id, tuple(ts), u_op, tuple(u_prev), u_id))
+
+    return records
+
+
+def _pad(ts, width):
+    return tuple(ts) + (0,) * (width - len(ts))
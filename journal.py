@@ -0,0 +1,230 @@
+import glob
+import json
+import os
+import threading
+
+
+class WriteAheadLog:
+    '''
+    Append-only log of the mutations made to a replica's data. Entries are
+    written to numbered log segments and fsynced in batches, so that an
+    update costs a single appended line rather than a rewrite of the data
+    files. Segments that have been compacted into a snapshot of the data are
+    recorded in a checkpoint file and deleted.
+    '''
+
+    def __init__(self, prefix='wal', sync_every=32):
+        self.prefix = prefix
+        self.sync_every = sync_every    # entries written between fsyncs
+        self.checkpoint_file = f'{prefix}.checkpoint'
+
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._written = 0   # entries written to the current segment
+
+        self.compacted = _read_checkpoint(self.checkpoint_file)
+        segments = self.segments()
+        self.segment = max(segments[-1] if segments else 0,
+                           self.compacted) + 1
+        self._file = open(self._segment_file(self.segment), 'a',
+                          encoding='utf-8')
+
+    def append(self, entry):
+        '''
+        Append an entry to the log, fsyncing if the batch is full.
+
+        Params:
+            (dict) entry: JSON serialisable description of a mutation
+        '''
+
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._unsynced += 1
+            self._written += 1
+            if self._unsynced >= self.sync_every:
+                self._sync()
+
+    def sync(self):
+        '''
+        Flush and fsync any entries written since the last sync.
+        '''
+
+        with self._lock:
+            self._sync()
+
+    def rotate(self):
+        '''
+        Close the current segment and start writing to a new one.
+
+        Returns:
+            segment: number of the last closed segment, or None if there is
+                     nothing to compact
+        '''
+
+        with self._lock:
+            if not self._written:
+                # Segments left over from before a restart may still need
+                # compacting even if nothing has been written since
+                closed = self.segment - 1
+                return closed if closed > self.compacted else None
+
+            self._sync()
+            self._file.close()
+
+            closed = self.segment
+            self.segment += 1
+            self._written = 0
+            self._file = open(self._segment_file(self.segment), 'a',
+                              encoding='utf-8')
+
+        return closed
+
+    def checkpoint(self, segment):
+        '''
+        Record that all segments up to and including segment are contained
+        in the data snapshot, and delete them.
+
+        Params:
+            (int) segment: number of the last compacted segment
+        '''
+
+        tmp = f'{self.checkpoint_file}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(segment))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_file)
+        self.compacted = segment
+
+        for s in self.segments():
+            if s <= segment:
+                os.remove(self._segment_file(s))
+
+    def replay(self):
+        '''
+        Generate the entries of all segments written since the last
+        checkpoint, in the order they were appended.
+        '''
+
+        for s in self.segments():
+            if s <= self.compacted:
+                continue
+            with open(self._segment_file(s), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the log after a crash
+                        break
+
+    def segments(self):
+        '''
+        Get the numbers of the log segments on disk, in ascending order.
+        '''
+
+        return _segments(self.prefix)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _sync(self):
+        if self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def _segment_file(self, segment):
+        return f'{self.prefix}.{segment:06d}.log'
+
+    @classmethod
+    def read(cls, prefix='wal'):
+        '''
+        Generate the entries of a log written since its last checkpoint,
+        without opening it for writing.
+
+        Params:
+            (string) prefix: prefix of the log's files
+        '''
+
+        log = cls.__new__(cls)
+        log.prefix = prefix
+        log.compacted = _read_checkpoint(f'{prefix}.checkpoint')
+        return log.replay()
+
+    @staticmethod
+    def discard(prefix='wal'):
+        '''
+        Delete a log and its checkpoint, when the data it was written against
+        has been replaced. The segments are deleted before the checkpoint, so
+        that compacted segments are never replayed.
+
+        Params:
+            (string) prefix: prefix of the log's files
+        '''
+
+        for s in _segments(prefix):
+            os.remove(f'{prefix}.{s:06d}.log')
+        try:
+            os.remove(f'{prefix}.checkpoint')
+        except FileNotFoundError:
+            pass
+
+
+class Compactor(threading.Thread):
+    '''
+    Background thread that periodically fsyncs a store's write-ahead log and
+    compacts it back into the store's data files. A final snapshot is always
+    written when it stops, so that the owner's state is saved.
+    '''
+
+    def __init__(self, store, lock, get_state, stopper, sync_interval=1.0,
+                 compact_interval=60.0):
+        super().__init__(daemon=True)
+
+        self.store = store
+        self.lock = lock    # excludes the store's writers
+        self.get_state = get_state  # state to save with the snapshot
+        self.stopper = stopper
+        self.sync_interval = sync_interval
+        self.compact_interval = compact_interval
+
+    def run(self):
+        '''
+        Override of threading.Thread run() method. Syncs the log every
+        sync_interval seconds and compacts it every compact_interval seconds.
+        '''
+
+        elapsed = 0.0
+        while not self.stopper.wait(self.sync_interval):
+            self.store.wal.sync()
+
+            elapsed += self.sync_interval
+            if elapsed >= self.compact_interval:
+                elapsed = 0.0
+                self._compact()
+
+        self._compact(force=True)
+        self.store.wal.close()
+        print('Stopper set, compactor thread stopping.')
+
+    def _compact(self, force=False):
+        try:
+            self.store.compact(self.lock, self.get_state, force)
+        except OSError as e:
+            print('Compaction failed: ', e)
+
+
+def _segments(prefix):
+    return sorted(int(name.split('.')[-2])
+                  for name in glob.glob(f'{prefix}.*.log'))
+
+
+def _read_checkpoint(checkpoint_file):
+    try:
+        with open(checkpoint_file) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class LoadTracker:
+    '''
+    Tracks the load on a replica manager: the number of requests being
+    handled and the latencies of recent requests. Reported to front ends so
+    that they can route requests away from slow replica managers.
+    '''
+
+    def __init__(self, window=256, horizon=10.0):
+        self.in_flight = 0  # number of requests being handled
+        self.horizon = horizon  # seconds for which latencies are counted
+
+        # (time finished, latency) of the most recent requests. Old latencies
+        # expire, so that a replica manager which has been avoided because it
+        # was slow is tried again
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self):
+        '''
+        Context manager around the handling of a request.
+        '''
+
+        start = time.monotonic()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                self.in_flight -= 1
+                self.latencies.append((end, end - start))
+
+    def p95(self):
+        '''
+        Returns:
+            95th percentile latency of requests in the last horizon seconds,
+            in seconds
+        '''
+
+        since = time.monotonic() - self.horizon
+        with self._lock:
+            latencies = sorted(l for t, l in self.latencies if t >= since)
+        if not latencies:
+            return 0.0
+        return latencies[int(len(latencies) * 0.95)]
@@ -0,0 +1,776 @@
+import csv
+import os
+import time
+import zlib
+from itertools import islice
+from tempfile import NamedTemporaryFile
+from snapshot import (save_snapshot, load_snapshot, encode_snapshot,
+                      decode_snapshot, replace_state, write_snapshot)
+from textindex import NGramIndex
+from digest import DigestTree, rating_hash, tag_hash, bucket_movies
+
+
+# Variables for data files
+movie_file = 'movies.csv'
+rating_file = 'ratings.csv'
+tag_file = 'tags.csv'
+snapshot_file = 'snapshot.bin'
+
+movies_fields = ['movieId', 'title', 'genres']
+ratings_fields = ['userId', 'movieId', 'rating', 'timestamp']
+tags_fields = ['userId', 'movieId', 'tag', 'timestamp']
+
+
+class MovieStore:
+    '''
+    In-memory store of the movie, rating and tag data held by a replica
+    manager. The CSV files are parsed once when the store is created, and
+    all queries are answered from hash indexes built over the parsed rows.
+    Updates are applied to the indexes and appended to a write-ahead log,
+    which is periodically compacted back into the CSV files and a binary
+    snapshot, from which the store is loaded instead of the CSV files if it
+    is up to date.
+    '''
+
+    def __init__(self, wal):
+        self.wal = wal  # write-ahead log of rating and tag mutations
+
+        # State saved with the snapshot by the owner of the store, and the
+        # changes to it journaled in the write-ahead log since
+        self.saved_state = None
+        self.journal = []
+
+        # Movie indexes
+        self.movies = {}        # movieId -> movie row
+        self.titles = {}        # normalised title -> movieId
+        self.genres = {}        # lowercase genre -> set of movieIds
+        self.positions = {}     # movieId -> position in movie file
+        self.title_index = NGramIndex()     # lowercase title -> movieId
+
+        # Rating and tag indexes
+        self.movie_ratings = {}     # movieId -> {userId -> rating row}
+        self.user_ratings = {}      # userId -> {movieId -> rating row}
+        self.movie_tags = {}        # movieId -> list of tag rows
+        self.user_tags = {}         # userId -> list of tag rows
+        self.tag_movies = {}        # lowercase tag -> set of movieIds
+        self.tag_index = NGramIndex()   # lowercase tag -> itself
+
+        # Running rating aggregates, kept up to date as ratings are applied
+        self.rating_totals = {}     # movieId -> [sum of ratings, count]
+        self.rating_counts = {}     # movieId -> {rating -> count}
+
+        # Digests of the ratings and tags, built when first compared with
+        # another replica's and kept up to date as rows are indexed after
+        self.digests = None
+
+        self._load()
+
+    def _load(self):
+        '''
+        Load the snapshot, or parse the CSV files if there is no snapshot of
+        their current contents, and build the indexes.
+        '''
+
+        tables, state = load_snapshot(snapshot_file)
+        if tables is not None:
+            sources = state.pop('sources')
+            self._finish_compaction(sources)
+        if tables is not None and sources == self._sources():
+            self._load_tables(tables)
+            self.saved_state = state
+        else:
+            self._load_csv()
+
+        # Re-apply mutations made since the CSV files were last compacted
+        for entry in self.wal.replay():
+            self._apply_entry(entry)
+
+    def _load_csv(self):
+        with open(movie_file, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                self._index_movie(dict(row))
+
+        with open(rating_file, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                self._index_rating(dict(row))
+
+        with open(tag_file, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                self._index_tag(dict(row))
+
+    def _load_tables(self, tables):
+        '''
+        Build the indexes from the columns of a snapshot, converting the
+        values back to strings as they would be read from the CSV files.
+        '''
+
+        for fields, table, index in [
+                (movies_fields, tables['movies'], self._index_movie),
+                (tags_fields, tables['tags'], self._index_tag)]:
+            for values in zip(*(table[field] for field in fields)):
+                index(dict(zip(fields, map(str, values))))
+
+        # A snapshot holds one rating per user and movie, so ratings are
+        # indexed without checking for overwrites, and the aggregates are
+        # counted in the same pass rather than updated rating by rating
+        table = tables['ratings']
+        counts = {}     # movieId -> {rating -> count}
+        for userId, movieId, rating, timestamp in zip(
+                *(table[field] for field in ratings_fields)):
+            row = {'userId': str(userId), 'movieId': str(movieId),
+                   'rating': str(rating), 'timestamp': str(timestamp)}
+            self.movie_ratings.setdefault(movieId, {})[userId] = row
+            self.user_ratings.setdefault(userId, {})[movieId] = row
+            movie_counts = counts.setdefault(movieId, {})
+            movie_counts[rating] = movie_counts.get(rating, 0) + 1
+
+        for movieId, movie_counts in counts.items():
+            self.rating_totals[movieId] = [
+                sum(r * n for r, n in movie_counts.items()),
+                sum(movie_counts.values())]
+            self.rating_counts[movieId] = {str(r): n for r, n in
+                                           movie_counts.items()}
+
+    @staticmethod
+    def _sources(directory='.'):
+        '''
+        Get the size and checksum of each CSV file, so that a snapshot is not
+        used if the files have been changed since it was written. The files'
+        contents are checked rather than their modification times, so that a
+        snapshot copied along with them, to seed a new replica, is still used.
+        '''
+
+        return {filename: _source(os.path.join(directory, filename))
+                for filename in [movie_file, rating_file, tag_file]}
+
+    @staticmethod
+    def _finish_compaction(sources):
+        '''
+        Move into place the CSV files written by a compaction which was
+        stopped after writing the snapshot, before replacing the files. The
+        staged files are only used if they are the ones the snapshot was
+        written with.
+
+        Params:
+            (dict) sources: sizes and checksums of the CSV files the
+                            snapshot was written with
+        '''
+
+        for filename in [rating_file, tag_file]:
+            staged = _staged(filename)
+            if os.path.exists(staged) and _source(staged) == sources[filename]:
+                os.replace(staged, filename)
+
+    def _apply_entry(self, entry):
+        '''
+        Apply a mutation read back from the write-ahead log. Replaying an
+        entry more than once has no further effect. Entries written by the
+        owner of the store, and the updates mutations were made by, are
+        collected in the journal for the owner to recover its state from.
+        '''
+
+        if entry['op'] not in ('rating', 'tag'):
+            self.journal.append(entry)
+            return
+
+        if 'update' in entry:
+            self.journal.append({'op': 'executed', **entry['update']})
+
+        row = entry['row']
+        if entry['op'] == 'rating':
+            self._index_rating(row)
+        elif row not in self.movie_tags.get(int(row['movieId']), []):
+            self._index_tag(row)
+
+    def _index_movie(self, row):
+        movieId = int(row['movieId'])
+        self.positions[movieId] = len(self.movies)
+        self.movies[movieId] = row
+        self.titles.setdefault(self._normalise_title(row['title']), movieId)
+        self.title_index.add(movieId, row['title'].lower())
+        for genre in row['genres'].lower().split('|'):
+            self.genres.setdefault(genre, set()).add(movieId)
+
+    def _index_rating(self, row):
+        movieId = int(row['movieId'])
+        userId = int(row['userId'])
+        ratings = self.movie_ratings.setdefault(movieId, {})
+
+        # Remove an overwritten rating from the aggregates before adding the
+        # new one
+        if userId in ratings:
+            self._aggregate_rating(movieId, ratings[userId]['rating'], -1)
+            if self.digests is not None:
+                self.digests.remove(movieId, rating_hash(ratings[userId]))
+        self._aggregate_rating(movieId, row['rating'], 1)
+        if self.digests is not None:
+            self.digests.add(movieId, rating_hash(row))
+
+        ratings[userId] = row
+        self.user_ratings.setdefault(userId, {})[movieId] = row
+
+    def _aggregate_rating(self, movieId, rating, n):
+        '''
+        Add (n = 1) or remove (n = -1) a rating from the aggregates of a movie.
+        '''
+
+        totals = self.rating_totals.setdefault(movieId, [0.0, 0])
+        totals[0] += n * float(rating)
+        totals[1] += n
+
+        counts = self.rating_counts.setdefault(movieId, {})
+        key = str(float(rating))
+        counts[key] = counts.get(key, 0) + n
+        if not counts[key]:
+            del counts[key]
+
+    def _index_tag(self, row):
+        movieId = int(row['movieId'])
+        userId = int(row['userId'])
+        self.movie_tags.setdefault(movieId, []).append(row)
+        self.user_tags.setdefault(userId, []).append(row)
+        if self.digests is not None:
+            self.digests.add(movieId, tag_hash(row))
+
+        tag = row['tag'].lower()
+        if tag not in self.tag_movies:
+            self.tag_movies[tag] = set()
+            self.tag_index.add(tag, tag)
+        self.tag_movies[tag].add(movieId)
+
+    def _in_file_order(self, movieIds, limit=None):
+        '''
+        Get the movie rows for a collection of movieIds, in the order the
+        movies appear in the movie file.
+
+        Params:
+            movieIds:    collection of movieIds to get the movies of
+            (int) limit: maximum number of movies to return
+        '''
+
+        ordered = sorted((m for m in movieIds if m in self.positions),
+                         key=self.positions.__getitem__)
+        return [dict(self.movies[movieId]) for movieId in ordered[:limit]]
+
+    @staticmethod
+    def _normalise_title(title):
+        '''
+        Strip the release year from a title and convert it to lowercase.
+        '''
+
+        return title.lower()[:-7]
+
+    def submit_rating(self, userId, title, rating, update=None):
+        '''
+        Submit a movie rating, overwriting an existing rating if one exists
+        for the given movie by the given user.
+
+        Params:
+            (int) userId:   the id of the user submitting the rating
+            (string) title: title of the movie to submit rating for
+            (float) rating: value of the rating (0 - 5)
+            (dict) update:  ID and timestamp of the update submitting the
+                            rating, written to the log with it
+
+        '''
+        movieId = int(self.get_movie_by_title(title)['movieId'])
+        existing_rating = self.user_ratings.get(userId, {}).get(movieId)
+
+        if existing_rating:
+            row = dict(existing_rating)
+            row['rating'] = str(rating)
+        else:
+            row = {'userId': str(userId), 'movieId': str(movieId),
+                   'rating': str(rating), 'timestamp': str(int(time.time()))}
+
+        # Rows are replaced rather than modified, so that a compaction can
+        # write out a snapshot of the rows without copying them
+        self._index_rating(row)
+        self._log_mutation({'op': 'rating', 'row': row}, update)
+
+    def submit_tag(self, userId, title, tag, update=None):
+        '''
+        Submit a tag for a movie.
+
+        Params:
+            (int) userId:   the id of the user submitting the rating
+            (string) title: title of the movie to submit tag for
+            (string) tag:   word to tag the movie with
+            (dict) update:  ID and timestamp of the update submitting the
+                            tag, written to the log with it
+
+        '''
+        movieId = self.get_movie_by_title(title)['movieId']
+        row = {'userId': str(userId), 'movieId': movieId,
+               'tag': tag, 'timestamp': str(int(time.time()))}
+        self._index_tag(row)
+        self._log_mutation({'op': 'tag', 'row': row}, update)
+
+    def _log_mutation(self, entry, update):
+        '''
+        Append a mutation to the write-ahead log, in the same entry as the
+        update that made it, so that after a crash the update is known to
+        have been executed if and only if the mutation is replayed.
+        '''
+
+        if update is not None:
+            entry['update'] = update
+        self.wal.append(entry)
+
+    def digest_tree(self):
+        '''
+        Get the digest tree of the ratings and tags, building it the first
+        time. Must be called while holding at least the readers' lock.
+
+        Returns:
+            (DigestTree) digests of the ratings and tags
+        '''
+
+        if self.digests is None:
+            digests = DigestTree()
+            for movieId, ratings in self.movie_ratings.items():
+                for row in ratings.values():
+                    digests.add(movieId, rating_hash(row))
+            for movieId, tags in self.movie_tags.items():
+                for row in tags:
+                    digests.add(movieId, tag_hash(row))
+            self.digests = digests
+
+        return self.digests
+
+    def bucket_rows(self, buckets):
+        '''
+        Get the ratings and tags of the movies in buckets of the digest tree.
+
+        Params:
+            (list) buckets: buckets of the digest tree
+
+        Returns:
+            rows: dictionary of the lists of rating and tag rows
+        '''
+
+        rows = {'ratings': [], 'tags': []}
+        for bucket in buckets:
+            for movieId in bucket_movies(bucket):
+                rows['ratings'] += self.movie_ratings.get(movieId, {}).values()
+                rows['tags'] += self.movie_tags.get(movieId, [])
+        return rows
+
+    def merge_rows(self, rows):
+        '''
+        Merge the ratings and tags of buckets of another replica's digest
+        tree into the store, so that both replicas have the same rows once
+        each has merged the other's. A rating missing here is added, and of
+        two ratings of a movie by the same user the higher is kept. A tag is
+        added as many times as it is missing here. Mutations are written to
+        the write-ahead log as usual.
+
+        Params:
+            (dict) rows: rating and tag rows, as returned by bucket_rows
+
+        Returns:
+            changed: list of the rating and tag rows added to the store
+        '''
+
+        changed = []
+        for row in rows['ratings']:
+            existing = self.user_ratings.get(int(row['userId']), {}).get(
+                int(row['movieId']))
+            if (existing is None or
+                    float(row['rating']) > float(existing['rating'])):
+                changed.append(row)
+                self._index_rating(row)
+                self._log_mutation({'op': 'rating', 'row': row}, None)
+
+        missing = {}    # (userId, movieId, tag) -> other's rows of the tag
+        for row in rows['tags']:
+            key = (int(row['userId']), int(row['movieId']), row['tag'])
+            missing.setdefault(key, []).append(row)
+        for movieId in {int(row['movieId']) for row in rows['tags']}:
+            for row in self.movie_tags.get(movieId, []):
+                key = (int(row['userId']), int(row['movieId']), row['tag'])
+                if missing.get(key):
+                    missing[key].pop()
+        for tags in missing.values():
+            for row in tags:
+                changed.append(row)
+                self._index_tag(row)
+                self._log_mutation({'op': 'tag', 'row': row}, None)
+
+        return changed
+
+    def compact(self, lock, get_state, force=False):
+        '''
+        Compact the write-ahead log into the CSV files and the snapshot. Only
+        closing the current log segment and taking a snapshot of the row
+        references and the owner's state is done while holding the given
+        lock. This is the read side of the owner's lock, which keeps updates
+        from being applied meanwhile but not other readers from running.
+
+        The new CSV files are written alongside the old ones, and only
+        replace them once the snapshot, with the owner's state, has been
+        written. A replica stopped part way through therefore keeps either
+        the old snapshot and CSV files, or the new snapshot, whose CSV files
+        are moved into place when it is next loaded.
+
+        Params:
+            (Lock) lock:          lock which excludes updates to the store,
+                                  e.g. the read side of a readers-writer
+                                  lock whose write side they hold
+            (function) get_state: returns the state to save with the
+                                  snapshot, as of the current store contents
+            (bool) force:         write the snapshot even if there is nothing
+                                  to compact, since the owner's state may
+                                  have changed
+        '''
+
+        with lock:
+            segment = self.wal.rotate()
+            if segment is None and not force:
+                return
+            tables = self._tables()
+            state = get_state()
+
+        state['sources'] = self._sources()
+        if segment is not None:
+            for filename, fields, rows in [
+                    (rating_file, ratings_fields, tables['ratings']),
+                    (tag_file, tags_fields, tables['tags'])]:
+                self._stage_csv(_staged(filename), fields, rows)
+                state['sources'][filename] = _source(_staged(filename))
+
+        save_snapshot(snapshot_file, tables, state)
+
+        if segment is not None:
+            for filename in [rating_file, tag_file]:
+                os.replace(_staged(filename), filename)
+            self.wal.checkpoint(segment)
+
+    def snapshot(self, lock, get_state):
+        '''
+        Encode a snapshot of the store and the owner's state, to transfer to
+        another replica. Only taking the row references and the owner's
+        state is done while holding the given lock, which excludes updates
+        as for compact.
+
+        Params:
+            (Lock) lock:          lock which excludes updates to the store
+            (function) get_state: returns the state to save with the
+                                  snapshot, as of the current store contents
+
+        Returns:
+            (bytes) data: snapshot encoded by encode_snapshot
+        '''
+
+        with lock:
+            tables = self._tables()
+            state = get_state()
+
+        return encode_snapshot(tables, state)
+
+    def _tables(self):
+        '''
+        Get the rows of each table. Rows are never changed once indexed, so
+        the lists can be written out after the lock is released.
+        '''
+
+        return {
+            'movies': list(self.movies.values()),
+            'ratings': [row for user in self.user_ratings.values()
+                        for row in user.values()],
+            'tags': [row for user in self.user_tags.values() for row in user]
+        }
+
+    @classmethod
+    def write_files(cls, data, directory):
+        '''
+        Write the CSV files and snapshot of a store received from another
+        replica, from which a store is then loaded. The snapshot is written
+        as received, with the checksums of the new CSV files added to its
+        state.
+
+        Params:
+            (bytes) data:       snapshot encoded by encode_snapshot
+            (string) directory: folder to write the files to
+        '''
+
+        tables, state = decode_snapshot(data)
+        if tables is None:
+            raise ValueError('Unsupported snapshot.')
+
+        for table, filename, fields in [
+                ('movies', movie_file, movies_fields),
+                ('ratings', rating_file, ratings_fields),
+                ('tags', tag_file, tags_fields)]:
+            columns = tables[table]
+            rows = [dict(zip(fields, map(str, values))) for values in
+                    zip(*(columns[field] for field in fields))]
+            cls._write_csv(os.path.join(directory, filename), fields, rows)
+
+        del state['log']
+        state['sources'] = cls._sources(directory)
+        write_snapshot(os.path.join(directory, snapshot_file),
+                       replace_state(data, state))
+
+    @staticmethod
+    def _write_csv(filename, fields, rows):
+        '''
+        Atomically replace a CSV file with the given rows.
+        '''
+
+        tempfile = NamedTemporaryFile(mode='w', dir='.', delete=False,
+                                      newline='')
+        with tempfile:
+            MovieStore._write_rows(tempfile, fields, rows)
+        os.replace(tempfile.name, filename)
+
+    @staticmethod
+    def _stage_csv(filename, fields, rows):
+        '''
+        Write the given rows to a CSV file, to be moved into place later.
+        '''
+
+        with open(filename, 'w', newline='') as f:
+            MovieStore._write_rows(f, fields, rows)
+
+    @staticmethod
+    def _write_rows(f, fields, rows):
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def get_avg_movie_rating(self, title):
+        '''
+        Get the average rating for a movie.
+
+        Params:
+            (string) title: title of the movie to get the average rating for
+
+        Returns:
+            movie_rating: average rating for the given movie, or None if the
+                          movie has not been rated
+        '''
+        movieId = int(self.get_movie_by_title(title)['movieId'])
+        total, count = self.rating_totals.get(movieId, (0.0, 0))
+
+        movie_rating = total / count if count else None
+        return movie_rating
+
+    def get_rating_stats(self, title):
+        '''
+        Get the number of ratings, average rating and distribution of ratings
+        for a movie.
+
+        Params:
+            (string) title: title of the movie to get the rating stats for
+
+        Returns:
+            stats: dictionary with the count, mean and distribution (rating ->
+                   number of ratings) of the movie's ratings
+        '''
+        movieId = int(self.get_movie_by_title(title)['movieId'])
+        total, count = self.rating_totals.get(movieId, (0.0, 0))
+        counts = self.rating_counts.get(movieId, {})
+
+        stats = {
+            'count': count,
+            'mean': total / count if count else None,
+            'distribution': {k: counts[k] for k in sorted(counts, key=float)}
+        }
+        return stats
+
+    def get_movie_ratings(self, userId=None, title=None, movieId=None):
+        '''
+        Get movie ratings. If no arguments given, return all movie ratings.
+
+        Params:
+            (int) userId:   id of the user whose ratings to get
+            (string) title: title of the movie to get the ratings for
+            (int) movieId:  id of the movie to get the ratings for
+
+        Returns:
+            ratings: list of movie ratings for filter criteria provided
+        '''
+        return list(self._iter_movie_ratings(userId, title, movieId))
+
+    def get_movie_ratings_page(self, userId=None, title=None, offset=0,
+                               limit=50):
+        '''
+        Get a page of movie ratings, so that large result sets can be fetched
+        a piece at a time.
+
+        Params:
+            (int) userId:   id of the user whose ratings to get
+            (string) title: title of the movie to get the ratings for
+            (int) offset:   index of the first rating to return
+            (int) limit:    maximum number of ratings to return
+
+        Returns:
+            ratings: list of at most limit movie ratings
+            next_offset: offset of the next page, or None if this is the last
+        '''
+        rows = self._iter_movie_ratings(userId, title)
+        ratings = list(islice(rows, offset, offset + limit + 1))
+
+        next_offset = None
+        if len(ratings) > limit:
+            ratings.pop()
+            next_offset = offset + limit
+
+        return ratings, next_offset
+
+    def _iter_movie_ratings(self, userId=None, title=None, movieId=None):
+        '''
+        Generate the movie ratings matching the filter criteria, joined with
+        the title of the rated movie. Rows are filtered using the indexes
+        before any are copied.
+        '''
+        if movieId:
+            movieId = int(movieId)
+        elif title:
+            movieId = int(self.get_movie_by_title(title)['movieId'])
+
+        if userId:
+            rows = self.user_ratings.get(userId, {})
+            if movieId:
+                rows = [rows[movieId]] if movieId in rows else []
+            else:
+                rows = rows.values()
+        elif movieId:
+            rows = self.movie_ratings.get(movieId, {}).values()
+        else:
+            rows = (row for user in self.user_ratings.values()
+                    for row in user.values())
+
+        for row in rows:
+            rating = dict(row)
+            rating['title'] = self.movies[int(row['movieId'])]['title']
+            yield rating
+
+    def get_movie_genres(self, title):
+        '''
+        Get all the genres for a movie.
+
+        Params:
+            (string) title: title of movie to get genres for
+
+        Returns:
+            genres: list of genres for the movie
+        '''
+        movie = self.get_movie_by_title(title)
+        genres = movie['genres'].split('|')
+        return genres
+
+    def get_movie_by_title(self, title):
+        '''
+        Get a movie based on the title.
+
+        Params:
+            (string) title: title of movie to get
+
+        Returns:
+            movie: dictionary representing line from the movie CSV file
+        '''
+        movieId = self.titles.get(title.lower())
+
+        if movieId is None:
+            raise Exception(f'No movie found for title [ {title} ].')
+
+        return dict(self.movies[movieId])
+
+    def get_movie_by_id(self, movieId):
+        '''
+        Get a movie based on the movieId.
+
+        Params:
+            (int) movieId: ID of movie to get
+
+        Returns:
+            movie: dictionary representing line from the movie CSV file
+        '''
+        movie = self.movies.get(movieId)
+
+        if movie is None:
+            raise Exception(f'No movie found for id [ {movieId} ].')
+
+        return dict(movie)
+
+    def get_movie_tags(self, title):
+        '''
+        Get all the tags for a movie.
+
+        Params:
+            (string) title: title of movie to get tags for
+
+        Returns:
+            genres: list of tags for the movie
+        '''
+        movieId = int(self.get_movie_by_title(title)['movieId'])
+        tags = list(dict.fromkeys(row['tag']
+                                  for row in self.movie_tags.get(movieId, [])))
+
+        return tags
+
+    def search_by_title(self, title, limit=None, prefix=False):
+        '''
+        Search movies by title.
+
+        Params:
+            (string) title: title to match against
+            (int) limit:    maximum number of movies to return
+            (bool) prefix:  only match titles starting with title
+
+        Returns:
+            movies: list of movies whose titles contain title as a substring
+        '''
+        movieIds = self.title_index.search(title.lower(), prefix)
+
+        return self._in_file_order(movieIds, limit)
+
+    def search_by_genre(self, genre):
+        '''
+        Search movies by genre.
+
+        Params:
+            (string) genre: genre to match against
+
+        Returns:
+            movies: list of movies belonging to the given genre
+        '''
+        genre = genre.lower()
+        movieIds = set()
+        for name, members in self.genres.items():
+            if genre in name:
+                movieIds |= members
+
+        return self._in_file_order(movieIds)
+
+    def search_by_tag(self, tag, limit=None, prefix=False):
+        '''
+        Search movies by tag.
+
+        Params:
+            (string) tag:  tag to match against
+            (int) limit:   maximum number of movies to return
+            (bool) prefix: only match tags starting with tag
+
+        Returns:
+            movies: list of movies that have been tagged with tag
+        '''
+        movieIds = set()
+        for match in self.tag_index.search(tag.lower(), prefix):
+            movieIds |= self.tag_movies[match]
+
+        return self._in_file_order(movieIds, limit)
+
+
+def _source(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [len(data), zlib.crc32(data)]
+
+
+def _staged(filename):
+    return f'{filename}.tmp'
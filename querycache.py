@@ -0,0 +1,151 @@
+import sys
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+
+class QueryCache:
+    '''
+    Least recently used cache of query results, limited by an estimate of
+    the memory used by the cached results. Each entry is tagged with the
+    parts of the data it depends on, so that an update only invalidates the
+    entries whose results it could change.
+    '''
+
+    SAMPLE = 16     # items measured when estimating the size of a sequence
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+        self._entries = OrderedDict()   # key -> (result, size, dependencies)
+        self._tagged = {}               # dependency -> set of keys
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        Look up a cached result.
+
+        Params:
+            key: hashable key of the query
+
+        Returns:
+            (bool) found: whether the result was cached
+            result: the cached result, or None
+        '''
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, result, dependencies):
+        '''
+        Cache a query result, evicting the least recently used results if the
+        cache is full. Results larger than the whole cache are not cached.
+
+        Params:
+            key:                  hashable key of the query
+            result:               result of the query
+            (set) dependencies:   tags of the data the result depends on
+        '''
+
+        size = self._sizeof(result)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (result, size, dependencies)
+            self.bytes += size
+            for dep in dependencies:
+                self._tagged.setdefault(dep, set()).add(key)
+
+            while self.bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, dependencies):
+        '''
+        Discard every cached result depending on any of the given tags.
+
+        Params:
+            (iterable) dependencies: tags of the data that has changed
+        '''
+
+        with self._lock:
+            for dep in dependencies:
+                for key in self._tagged.pop(dep, ()):
+                    if self._discard(key):
+                        self.invalidations += 1
+
+    def stats(self):
+        '''
+        Returns:
+            stats: dictionary of cache statistics
+        '''
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+
+        _, size, dependencies = entry
+        self.bytes -= size
+        for dep in dependencies:
+            keys = self._tagged.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[dep]
+        return True
+
+    @classmethod
+    def _sizeof(cls, obj):
+        '''
+        Estimate the memory used by a result. The size of a long sequence is
+        extrapolated from its first few items.
+        '''
+
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            sample = [x for item in islice(obj.items(), cls.SAMPLE)
+                      for x in item]
+            n = len(obj)
+            k = min(n, cls.SAMPLE)
+        elif isinstance(obj, (list, tuple, set)):
+            sample = list(islice(obj, cls.SAMPLE))
+            n = len(obj)
+            k = len(sample)
+        else:
+            return size
+
+        if not k:
+            return size
+        return size + sum(cls._sizeof(x) for x in sample) * n // k
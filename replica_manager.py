@@ -1,373 +1,397 @@
-import csv
 import os
-import queue
 import random
-import shutil
 import signal
 import threading
 import time
 import Pyro4
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from itertools import zip_longest
 from sys import path, argv, platform
-from tempfile import NamedTemporaryFile
 
 
-REPLICA_NUM = 3     # Number of replicas in system
+# Number of replicas the system starts with, set by the REPLICA_NUM
+# environment variable. Further replica managers may join and leave later
+REPLICA_NUM = int(os.environ.get('REPLICA_NUM', 3))
+QUERY_CACHE_BYTES = 32 * 2**20  # Memory limit of the query result cache
 
-# Variables for data files
-movie_file = 'movies.csv'
-rating_file = 'ratings.csv'
-tag_file = 'tags.csv'
 
-movies_fields = ['movieId', 'title', 'genres']
-ratings_fields = ['userId', 'movieId', 'rating', 'timestamp']
-tags_fields = ['userId', 'movieId', 'tag', 'timestamp']
-
-
-def submit_rating(userId, title, rating):
+def tracked(method):
     '''
-    Submit a movie rating, overwriting an existing rating if one exists
-    for the given movie by the given user.
-
-    Params:
-        (int) userId:   the id of the user submitting the rating
-        (string) title: title of the movie to submit rating for
-        (float) rating: value of the rating (0 - 5)
-
+    Decorator for request handling methods, recording each request in the
+    replica manager's load statistics.
     '''
-    movieId = get_movie_by_title(title)['movieId']
-    existing_rating = get_movie_ratings(userId, None, movieId)
-
-    if existing_rating:
-        tempfile = NamedTemporaryFile(mode='w', delete=False)
-        with open(rating_file, 'r', newline='') as csvfile, tempfile:
-            reader = csv.DictReader(csvfile)
-            writer = csv.DictWriter(tempfile, ratings_fields)
-            writer.writeheader()
-            for row in reader:
-                if (row['movieId'] == existing_rating[0]['movieId'] and
-                        row['userId'] == existing_rating[0]['userId']):
-                    new_row = row
-                    new_row['rating'] = rating
-                    writer.writerow(new_row)
-                else:
-                    writer.writerow(row)
-        shutil.move(tempfile.name, rating_file)
-    else:
-        with open(rating_file, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, ratings_fields)
-            timestamp = str(int(time.time()))
-            writer.writerow({'userId': userId, 'movieId': movieId,
-                             'rating': rating, 'timestamp': timestamp})
 
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.load.track():
+            return method(self, *args, **kwargs)
 
-def submit_tag(userId, title, tag):
-    '''
-    Submit a tag for a movie.
+    return wrapper
 
-    Params:
-        (int) userId:   the id of the user submitting the rating
-        (string) title: title of the movie to submit tag for
-        (string) tag:   word to tag the movie with
 
+def import_modules():
     '''
-    movieId = get_movie_by_title(title)['movieId']
-    with open(tag_file, 'a', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, tags_fields)
-
-        writer.writerow({'userId': userId, 'movieId': movieId,
-                         'tag': tag, 'timestamp': str(int(time.time()))})
-
-
-def get_avg_movie_rating(title):
+    Import the modules the replica manager uses into this module. They are
+    imported once the working directory has been changed to the replica's
+    data folder, by the main block, or by anything else that creates a
+    ReplicaManager, such as the benchmarks.
     '''
-    Get the average rating for a movie.
 
-    Params:
-        (string) title: title of the movie to get the average rating for
-
-    Returns:
-        movie_rating: average rating for the given movie
-    '''
-    movieId = get_movie_by_title(title)['movieId']
-    ratings = []
-    with open(rating_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+    global SignalHandler, VectorClock, FrozenVectorClock, covered, Status
+    global ROp, MovieStore, WriteAheadLog, Compactor, PendingUpdates
+    global WaitRegistry, UpdateExecutor, UpdateLog, encode_gossip
+    global decode_gossip, GossipScheduler, RWLock, QueryCache, LoadTracker
+    global TransferSource, bootstrap, finish_install, differing_buckets
 
-        ratings = [float(row['rating']) for row in reader
-                   if row['movieId'] == movieId]
-
-    movie_rating = sum(ratings) / len(ratings)
-    return movie_rating
-
-
-def get_movie_ratings(userId=None, title=None, movieId=None):
-    '''
-    Get movie ratings. If no arguments given, return all movie ratings.
+    from signalhandler import SignalHandler
+    from vectorclock import VectorClock, FrozenVectorClock, covered
+    from enums import Status, ROp
+    from moviestore import MovieStore
+    from journal import WriteAheadLog, Compactor
+    from causal import PendingUpdates, WaitRegistry, UpdateExecutor
+    from updatelog import UpdateLog
+    from gossipcodec import encode_gossip, decode_gossip
+    from scheduler import GossipScheduler
+    from rwlock import RWLock
+    from querycache import QueryCache
+    from loadstats import LoadTracker
+    from statetransfer import TransferSource, bootstrap, finish_install
+    from digest import differing_buckets
 
-    Params:
-        (int) userId:   id of the user whose ratings to get
-        (string) title: title of the movie to get the ratings for
-        (int) movieId:  id of the movie to get the ratings for
 
-    Returns:
-        ratings: list of movie ratings for filter criteria provided
-    '''
-    ratings = []
-    with open(rating_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        ratings = [dict(row) for row in reader]
-        if userId:
-            ratings = [row for row in ratings
-                       if int(row['userId']) == userId]
-        if movieId:
-            ratings = [row for row in ratings
-                       if row['movieId'] == movieId]
-        elif title:
-            movieId = get_movie_by_title(title)['movieId']
-            ratings = [row for row in ratings
-                       if row['movieId'] == movieId]
-
-    for r in ratings:
-        r['title'] = get_movie_by_id(int(r['movieId']))['title']
-
-    return ratings
-
-
-def get_movie_genres(title):
+@Pyro4.expose
+class ReplicaManager(threading.Thread):
     '''
-    Get all the genres for a movie.
-
-    Params:
-        (string) title: title of movie to get genres for
-
-    Returns:
-        genres: list of genres for the movie
+    Class for a Replica Server within the distributed system, implementing
+    the gossip architecture.
     '''
-    movie = get_movie_by_title(title)
-    genres = movie['genres'].split('|')
-    return genres
 
+    def __init__(self, replica_id, stopper, status=None):
+        super().__init__()
 
-def get_movie_by_title(title):
-    '''
-    Get a movie based on the title.
-
-    Params:
-        (string) title: title of movie to get
+        self._id = replica_id
 
-    Returns:
-        movie: dictionary representing line from the movie CSV file
-    '''
-    movie = []
-    with open(movie_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-
-        movie = next(reader, None)
-        while movie is not None:
-            if movie['title'].lower()[:-7] != title.lower():
-                movie = next(reader, None)
-            else:
-                break
+        # Replica status properties
+        self.failure_prob = 0.1
+        self.overload_prob = 0.2
+        self.auto_status = True
+        if status not in [n.value for n in list(Status)]:
+            print('Invalid status provided, defaulting to active.')
+            self.status = Status.ACTIVE
+        else:
+            self.status = Status(status)
+            self.auto_status = False
+            print(f'Status set to {status}.',
+                  'Automatic status updating disabled.')
 
-    if not movie:
-        raise Exception(f'No movie found for title [ {title} ].')
+        # Replica data, loaded once from the data files and write-ahead log,
+        # after finishing installing any snapshot received from another
+        finish_install()
+        self.store = MovieStore(WriteAheadLog())
+        self.cache = QueryCache(QUERY_CACHE_BYTES)  # results of queries
+        self.transfers = TransferSource()   # snapshots sent to other replicas
 
-    return dict(movie)
+        # Gossip Architecture State
+        self.value_ts = VectorClock(REPLICA_NUM)  # aka data timestamp
+        self.replica_ts = VectorClock(REPLICA_NUM)  # aka log timestamp
+        self.update_log = UpdateLog()
+        self.pending = PendingUpdates()  # records of updates not executed yet
+        self.ts_table = {i: VectorClock(REPLICA_NUM)  # replica ID -> its ts
+                         for i in range(REPLICA_NUM) if i != self._id}
+        self.departed = set()   # IDs of replica managers which have left
+        self.executed = set()
+        self.waiters = WaitRegistry()   # queries waiting for updates
+        self.query_timeout = 10.0   # seconds a query may wait to be stable
+        self.load = LoadTracker()   # requests in flight and their latencies
+        self.interval = 8.0  # interval between automatic status updates
+        self.scheduler = GossipScheduler(max_interval=self.interval)
+
+        # Proxies for the other replica managers, reused between gossip rounds
+        self.peers = {}     # replica ID -> proxy
+        self.in_flight = set()  # IDs of peers gossip is being sent to
+        self.gossip_timeout = 2.0   # timeout for sending gossip to a peer
+        self.discovery_interval = 30.0  # interval between peer lookups
+        self.anti_entropy_interval = 60.0   # between digest comparisons
+        self.next_discovery = 0.0
+        self.gossip_pool = ThreadPoolExecutor(max_workers=REPLICA_NUM)
 
+        self.stopper = stopper  # Used to indicate to server to stop
 
-def get_movie_by_id(movieId):
-    '''
-    Get a movie based on the movieId.
+        # Locks for objects shared between threads. Queries share the read
+        # side of store_lock, so they only wait for the short time in which an
+        # update is applied to the store and value_ts under its write side
+        self.store_lock = RWLock()  # for store, cache and value_ts
+        self.vts_lock = threading.Lock()    # for pending, waiters, executed
+        self.rts_lock = threading.Lock()    # for replica_ts
+        self.log_lock = threading.Lock()    # for update_log
+        self.peer_lock = threading.Lock()   # for peers, in_flight, ts_table
 
-    Params:
-        (string) movieId: ID of movie to get
+        # Update log garbage collection and anti-entropy statistics, both
+        # updated while holding vts_lock
+        self.gc_stats = {'runs': 0, 'discarded': 0,
+                         'log_before': 0, 'log_after': 0}
+        self.ae_stats = {'rounds': 0, 'buckets': 0, 'repaired': 0}
 
-    Returns:
-        movie: dictionary representing line from the movie CSV file
-    '''
-    movie = []
-    with open(movie_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-
-        movie = next(reader, None)
-        while movie is not None:
-            if int(movie['movieId']) != movieId:
-                movie = next(reader, None)
-            else:
-                break
+        # Thread which executes updates acknowledged before being executed
+        self.executor = UpdateExecutor(self._execute_pending, stopper)
 
-    return dict(movie)
+        # Thread which syncs and compacts the write-ahead log of the store.
+        # It is stopped after the update executor, so that every update
+        # executed is written to the log
+        self.store_stopper = threading.Event()
+        self.compactor = Compactor(self.store, self.store_lock.reader,
+                                   self._save_state, self.store_stopper)
 
+        # Carry on from the state saved with the store's snapshot and the
+        # changes to it journaled in the store's write-ahead log
+        if self.store.saved_state is not None or self.store.journal:
+            self._restore_state(self.store.saved_state, self.store.journal)
 
-def get_movie_tags(title):
-    '''
-    Get all the tags for a movie.
+    def run(self):
+        '''
+        Override of threading.Thread run() method. Sends gossip to other
+        replica managers whenever the gossip scheduler says it is due.
+        '''
 
-    Params:
-        (string) title: title of movie to get tags for
+        self.compactor.start()
+        self.executor.start()
+        self._announce()
+        next_status = time.monotonic() + self.interval
+        next_anti_entropy = time.monotonic() + self.anti_entropy_interval
 
-    Returns:
-        genres: list of tags for the movie
-    '''
-    movieId = get_movie_by_title(title)['movieId']
-    tags = []
-    with open(tag_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+        while not self.stopper.is_set():
+            due = self.scheduler.wait(self.stopper, list(self.peers))
+
+            if self.status == Status.OFFLINE:
+                # Defer gossip until back online
+                for r_id in due:
+                    self.scheduler.sent(r_id, 0)
+            elif not self.stopper.is_set():
+                if not self.peers or time.monotonic() >= self.next_discovery:
+                    # Gossip to newly found replica managers straight away
+                    due += self._refresh_replicas()
+
+                self._send_gossip_round(due)
+
+                if time.monotonic() >= next_anti_entropy:
+                    next_anti_entropy = (time.monotonic() +
+                                         self.anti_entropy_interval)
+                    self._start_anti_entropy()
+
+            if time.monotonic() >= next_status:
+                next_status = time.monotonic() + self.interval
+                if self.auto_status:
+                    self._update_status()
+                print('Status: ', self.status.value, '\n')
+
+        self.gossip_pool.shutdown()
+        for rm in self.peers.values():
+            rm._pyroRelease()
+        self.executor.join()
+        self.store_stopper.set()
+        self.compactor.join()
+        print('Stopper set, gossip thread stopping.')
 
-        tags = list({row['tag'] for row in reader
-                     if row['movieId'] == movieId})
+    def _send_gossip_round(self, due):
+        '''
+        Send gossip to each of the given peers concurrently. The log and
+        replica timestamp are only locked while the messages are prepared, and
+        each message is sent from the gossip thread pool, so a slow peer does
+        not hold up gossip to the others or block updates.
 
-    return tags
+        Params:
+            (list) due: IDs of the peers to send gossip to
+        '''
 
+        with self.peer_lock:
+            due = [r_id for r_id in due
+                   if r_id in self.peers and r_id not in self.in_flight]
+            self.in_flight.update(due)
+            table = {r_id: self.ts_table.get(r_id, VectorClock(0))
+                     for r_id in due}
+            proxies = {r_id: self.peers[r_id] for r_id in due}
 
-def search_by_title(title):
-    '''
-    Search movies by title.
+        if not due:
+            return
 
-    Params:
-        (string) title: title to match against
+        with self.rts_lock:
+            m_ts = self.replica_ts.value()
+            messages = [(r_id, self._get_recent_updates(table[r_id]))
+                        for r_id in due]
 
-    Returns:
-        movies: list of movies whose titles contain title as a substring
-    '''
-    title = title.lower()
-    movies = []
-    with open(movie_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+        # Records are journaled before replica_ts covers them, but may not be
+        # on disk yet. Peers must never be told of a record which could be
+        # lost in a crash, since its timestamp would then be reused
+        self.store.wal.sync()
 
-        movies = [dict(row) for row in reader if title in row['title'].lower()]
+        print('\n--- SENDING GOSSIP ---')
+        for r_id, m_log in messages:
+            print(f'Updates to send to RM {r_id}: ', m_log)
+            self.gossip_pool.submit(self._send_gossip_to, r_id,
+                                    proxies[r_id], m_log, m_ts)
+        print('----------------------')
 
-    return movies
+    def _send_gossip_to(self, r_id, rm, m_log, m_ts):
+        '''
+        Send gossip to a single peer. Run in the gossip thread pool.
 
+        Params:
+            (int) r_id:     ID of the peer
+            (Proxy) rm:     proxy for the peer
+            (list) m_log:   updates to send to the peer
+            (tuple) m_ts:   our replica timestamp when m_log was taken
+        '''
 
-def search_by_genre(genre):
-    '''
-    Search movies by genre.
+        try:
+            rm.send_gossip(encode_gossip(m_log), m_ts, self._id)
+            print(f'Gossip sent to RM {r_id}')
+        except Pyro4.errors.CommunicationError:
+            print(f'Failed to send gossip to RM {r_id}')
+            self.next_discovery = 0.0   # look the peer up again
+        finally:
+            self.scheduler.sent(r_id, len(m_log))
+            with self.peer_lock:
+                self.in_flight.discard(r_id)
+
+    def _start_anti_entropy(self):
+        '''
+        Compare digests with a randomly chosen peer, in the gossip thread
+        pool. A proxy of its own is used, so that gossip to the peer is not
+        held up.
+        '''
 
-    Params:
-        (string) genre: genre to match against
+        with self.peer_lock:
+            if not self.peers:
+                return
+            r_id, rm = random.choice(list(self.peers.items()))
 
-    Returns:
-        movies: list of movies belonging to the given genre
-    '''
-    genre = genre.lower()
-    movies = []
-    with open(movie_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+        self.gossip_pool.submit(self._anti_entropy, r_id, rm._pyroUri)
 
-        movies = [dict(row) for row in reader
-                  if genre in row['genres'].lower()]
+    def _anti_entropy(self, r_id, uri):
+        '''
+        Compare the digests of the ratings and tags with those of a peer,
+        and exchange the rows of the buckets in which they differ. Digests
+        are only compared when both have executed the same updates, since
+        otherwise they also differ by the updates still being gossiped.
 
-    return movies
+        Params:
+            (int) r_id: ID of the peer
+            (URI) uri:  URI of the peer
+        '''
 
+        def ours(depth, parents):
+            with self.store_lock.reader:
+                return self.store.digest_tree().digests(depth, parents)
 
-def search_by_tag(tag):
-    '''
-    Search movies by tag.
+        try:
+            with Pyro4.Proxy(uri) as rm:
+                rm._pyroTimeout = self.gossip_timeout
+                if self.value_ts != VectorClock.fromiterable(
+                        rm.get_value_ts()):
+                    return
 
-    Params:
-        (string) tag: tag to match against
+                buckets = differing_buckets(ours, rm.get_digests)
+                with self.vts_lock:
+                    self.ae_stats['rounds'] += 1
+                if not buckets:
+                    return
+
+                with self.store_lock.reader:
+                    v_ts = self.value_ts.value()
+                    rows = self.store.bucket_rows(buckets)
+                theirs = rm.exchange_buckets(buckets, rows, v_ts)
+        except Pyro4.errors.CommunicationError:
+            print(f'Failed to compare digests with RM {r_id}')
+            return
 
-    Returns:
-        movies: list of movies that have been tagged with tag
-    '''
-    tag = tag.lower()
-    movies = []
-    with open(tag_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+        if theirs is None:
+            return
 
-        movies = [row['movieId'] for row in reader
-                  if tag in row['tag'].lower()]
+        # Both replicas merge the other's rows, so they end up the same
+        repaired = 0
+        with self.store_lock.writer:
+            if self.value_ts == VectorClock.fromiterable(v_ts):
+                repaired = self._repair(theirs)
+        with self.vts_lock:
+            self.ae_stats['buckets'] += len(buckets)
+            self.ae_stats['repaired'] += repaired
+        print(f'Exchanged {len(buckets)} differing buckets with RM {r_id}')
 
-    with open(movie_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+    def get_digests(self, depth, parents):
+        '''
+        Method invoked by a replica manager comparing digests of the ratings
+        and tags with this one.
 
-        movies = [dict(row) for row in reader
-                  if row['movieId'] in movies]
+        Params:
+            (int) depth:    depth of the digest tree nodes, 0 for buckets
+            (list) parents: nodes to get the children of, or None for all
 
-    return movies
+        Returns:
+            digests: node -> digest
+        '''
 
+        with self.store_lock.reader:
+            return self.store.digest_tree().digests(depth, parents)
 
-@Pyro4.expose
-class ReplicaManager(threading.Thread):
-    '''
-    Class for a Replica Server within the distributed system, implementing
-    the gossip architecture.
-    '''
+    def exchange_buckets(self, buckets, rows, m_ts):
+        '''
+        Method invoked by a replica manager whose digests differ from this
+        one's, to exchange the rows of the buckets in which they differ.
 
-    def __init__(self, replica_id, stopper, status=None):
-        super().__init__()
+        Params:
+            (list) buckets: buckets of the digest tree which differ
+            (dict) rows:    the other replica manager's rows in the buckets
+            (tuple) m_ts:   value timestamp of the other replica manager
 
-        self._id = replica_id
+        Returns:
+            rows: this replica manager's rows in the buckets, from before
+                  merging the other's, or None if the replica managers
+                  have not executed the same updates
+        '''
 
-        # Replica status properties
-        self.failure_prob = 0.1
-        self.overload_prob = 0.2
-        self.auto_status = True
-        if status not in [n.value for n in list(Status)]:
-            print('Invalid status provided, defaulting to active.')
-            self.status = Status.ACTIVE
-        else:
-            self.status = Status(status)
-            self.auto_status = False
-            print(f'Status set to {status}.',
-                  'Automatic status updating disabled.')
+        if self.status == Status.OFFLINE:
+            return None
 
-        # Gossip Architecture State
-        self.value_ts = VectorClock(REPLICA_NUM)  # aka data timestamp
-        self.replica_ts = VectorClock(REPLICA_NUM)  # aka log timestamp
-        self.update_log = []
-        self.ts_table = [VectorClock(REPLICA_NUM) if i != self._id else None
-                         for i in range(REPLICA_NUM)]
-        self.executed = []
-        self.pending_queries = queue.Queue()
-        self.query_results = {}
-        self.interval = 8.0  # interval between gossip exchanges
-        self.other_replicas = self._find_replicas()
+        with self.store_lock.writer:
+            if self.value_ts != VectorClock.fromiterable(m_ts):
+                return None
+            ours = self.store.bucket_rows(buckets)
+            repaired = self._repair(rows)
+        with self.vts_lock:
+            self.ae_stats['repaired'] += repaired
+        return ours
 
-        self.stopper = stopper  # Used to indicate to server to stop
+    def _repair(self, rows):
+        '''
+        Merge another replica manager's rows of buckets in which the digests
+        of the ratings and tags differ, and discard the cached results they
+        change. Must be called while holding the write side of store_lock.
 
-        # Locks for objects shared between threads
-        self.vts_lock = threading.Lock()    # for value_ts
-        self.rts_lock = threading.Lock()    # for replica_ts
-        self.log_lock = threading.Lock()    # for update_log
+        Params:
+            (dict) rows: rating and tag rows, as returned by bucket_rows
 
-    def run(self):
-        '''
-        Override of threading.Thread run() method. Sends gossip to other
-        replica managers periodically.
+        Returns:
+            (int) number of rows changed
         '''
 
-        while not self.stopper.is_set():
-            if self.status != Status.OFFLINE:
-                for r_id, rm in self.other_replicas:
-                    rm._pyroRelease()
-                self.other_replicas = self._find_replicas()
-
-                with self.rts_lock:
-                    print('\n--- SENDING GOSSIP ---')
-                    for r_id, rm in self.other_replicas:
-                        r_ts = self.ts_table[r_id]
-                        m_log = self._get_recent_updates(r_ts)
-
-                        print(f'Updates to send to RM {r_id}: ', m_log)
-
-                        try:
-                            rm.send_gossip(m_log,
-                                           self.replica_ts.value(),
-                                           self._id)
-                            print(f'Gossip sent to RM {r_id}')
-                        except Pyro4.errors.CommunicationError as e:
-                            print(f'Failed to send gossip to RM {r_id}')
-                    print('----------------------')
-
-            if self.auto_status:
-                self._update_status()
-            print('Status: ', self.status.value, '\n')
-            self.stopper.wait(self.interval)
+        changed = self.store.merge_rows(rows)
 
-        print('Stopper set, gossip thread stopping.')
+        deps = set()
+        for row in changed:
+            movieId = int(row['movieId'])
+            if 'rating' in row:
+                deps |= {('ratings', movieId), ('user', int(row['userId'])),
+                         ('ratings',)}
+            else:
+                deps |= {('tags', movieId), ('tags',)}
+        self.cache.invalidate(deps)
 
+        if changed:
+            print(f'Repaired {len(changed)} ratings and tags.')
+        return len(changed)
+
+    @tracked
     def send_query(self, q_op, q_prev):
         '''
         Method invoked by the front end to send a query.
@@ -377,39 +401,83 @@ class ReplicaManager(threading.Thread):
             (tuple) q_prev: vector timestamp of front end
 
         Returns:
-            response: results of query
+            response: results of query, value timestamp and the load report
+                      of the replica manager
         '''
 
         print('Query received: ', q_op, q_prev)
-        response = None
 
         q_prev = VectorClock.fromiterable(q_prev)
+        response = self._query(q_op, q_prev)
+
+        return (*response, self.get_load())
+
+    def _query(self, q_op, q_prev):
+        '''
+        Execute a query once it is stable.
+
+        Params:
+            (string) q_op:        query command
+            (VectorClock) q_prev: vector timestamp of front end
+
+        Returns:
+            response: results of query and value timestamp
+        '''
 
         # stable = are we up to date enough to handle the query correctly?
-        stable = False
+        response = self._try_query(q_op, q_prev)
 
-        with self.vts_lock:
-            if q_prev <= self.value_ts:  # stability criteria for query
-                val = self._apply_query(q_op)
-                new = self.value_ts.value()
-                response = (val, new)
-                stable = True
-                print('Value timestamp: ', self.value_ts.value(), '\n')
+        if response is None:
+            # if not stable, wait to be woken when value_ts reaches q_prev.
+            # value_ts only advances while vts_lock is held, so no update can
+            # be missed between the check above and registering
+            with self.vts_lock:
+                waiter = self.waiters.register(q_prev, self.value_ts,
+                                               self.query_timeout)
 
-        if not stable:
-            # if not stable, add to a dictionary of pending queries and wait
-            self.query_results[(q_op, q_prev.value())] = queue.Queue(maxsize=1)
-            self.pending_queries.put((q_op, q_prev))
+            # Gossip now, so that peers holding the missing updates see that
+            # this replica manager is behind and send them back promptly
+            self.scheduler.notify()
 
-            # Wait for query to be executed after some gossip exchange
-            response = self.query_results[(q_op, q_prev.value())].get()
+            if not waiter.wait():
+                with self.vts_lock:
+                    self.waiters.cancel(waiter)
 
-            # Remove entry from pending query dictionary
-            del self.query_results[(q_op, q_prev.value())]
+            response = self._try_query(q_op, q_prev)
+            if response is None:
+                raise TimeoutError(
+                    f'Query could not be answered by RM {self._id} within '
+                    f'{self.query_timeout} seconds: it is missing updates '
+                    f'up to {q_prev}.')
 
         return response
 
-    def send_update(self, u_op, u_prev, u_id):
+    def _try_query(self, q_op, q_prev):
+        '''
+        Execute a query if it is stable. The store and value_ts are read
+        together under the read side of store_lock, so the result is
+        consistent with the timestamp returned with it.
+
+        Params:
+            (string) q_op:        query command
+            (VectorClock) q_prev: vector timestamp of front end
+
+        Returns:
+            response: results of query and value timestamp, or None if the
+                      query is not yet stable
+        '''
+
+        with self.store_lock.reader:
+            if not q_prev <= self.value_ts:  # stability criteria for query
+                return None
+            val = self._apply_query(q_op)
+            new = self.value_ts.value()
+
+        print('Value timestamp: ', new, '\n')
+        return (val, new)
+
+    @tracked
+    def send_update(self, u_op, u_prev, u_id, wait=True):
         '''
         Method invoked by the front end to send an update.
 
@@ -417,38 +485,194 @@ class ReplicaManager(threading.Thread):
             (string) u_op:  update command
             (tuple) u_prev: vector timestamp of front end
             (string) u_id:  unique ID for update
+            (bool) wait:    whether to wait for the update to be executed,
+                            rather than returning once it has been logged
 
         Returns:
             ts: timestamp representing having executed the update or None
                 if the update has already been executed
+            load: load report of the replica manager
         '''
         print('Update received: ', u_op, u_prev, u_id)
         ts = None
 
-        # Add update to log if it hasn't already been executed
-        if u_id not in self.executed:
-            with self.rts_lock:
-                self.replica_ts.increment(self._id)
-                ts = list(u_prev[:])
-                ts[self._id] = self.replica_ts.value()[self._id]
-                print('Replica timestamp: ', self.replica_ts, '\n')
+        # Add update to log if it hasn't already been executed. An update
+        # resent after a failure gets the timestamp it was first logged with
+        if u_id not in self.executed or (u_id, self._id) in self.update_log:
+            records, errors = self._accept_updates([(u_op, u_id)], u_prev,
+                                                   wait)
+
+            if u_id in errors:
+                raise errors[u_id]
+
+            ts = records[-1][1].value()
+
+        return ts, self.get_load()
+
+    @tracked
+    def send_batch(self, batch, prev, wait=True):
+        '''
+        Method invoked by the front end to send a batch of requests, which
+        are handled in order, each causally following those before it. Each
+        run of consecutive updates is added to the update log at once.
+
+        Params:
+            (list) batch:   (command, update ID) of each request, with None
+                            as the update ID of queries
+            (tuple) prev:   vector timestamp of front end
+            (bool) wait:    whether to wait for the updates to be executed,
+                            rather than returning once they have been logged
+
+        Returns:
+            results: (succeeded, result) of each request, where result is the
+                     result of a query, None for an update, or a description
+                     of the error if the request failed
+            ts: timestamp reflecting every request in the batch
+            load: load report of the replica manager
+        '''
+
+        print(f'Batch of {len(batch)} requests received: ', prev)
+
+        results = []
+        prev = VectorClock.fromiterable(prev)
+        i = 0
+        while i < len(batch):
+            op, u_id = batch[i]
+            if u_id is None:
+                try:
+                    val, new = self._query(op, prev)
+                    prev.merge(VectorClock.fromiterable(new))
+                    results.append((True, val))
+                except Exception as e:
+                    results.append((False, str(e)))
+                i += 1
+                continue
+
+            run = []
+            while i < len(batch) and batch[i][1] is not None:
+                run.append(batch[i])
+                i += 1
+
+            # Skip any updates which have already been executed, unless they
+            # were logged here and are being resent
+            records, errors = self._accept_updates(
+                [(op, u_id) for op, u_id in run
+                 if u_id not in self.executed or
+                 (u_id, self._id) in self.update_log],
+                prev.value(), wait)
+            if records:
+                prev.merge(records[-1][1])
+            for op, u_id in run:
+                if u_id in errors:
+                    results.append((False, str(errors[u_id])))
+                else:
+                    results.append((True, None))
+
+        return results, prev.value(), self.get_load()
+
+    def _accept_updates(self, updates, u_prev, wait=True):
+        '''
+        Add updates from the front end to the update log, each causally
+        following the one before it, and execute those that are stable.
+        Updates which could never succeed, e.g. for an unknown title, are
+        rejected without being logged. An update already logged here, resent
+        by a front end after a failure, is not logged again, and its
+        existing record is returned.
+
+        Params:
+            (list) updates: (update command, update ID) of each update
+            (tuple) u_prev: vector timestamp of front end
+            (bool) wait:    whether to execute the updates before returning,
+                            or leave them to the update executor
+
+        Returns:
+            records: list of the update log records of the updates
+            errors: dictionary of exceptions raised by updates, by update ID
+        '''
 
-            ts = VectorClock.fromiterable(ts)
+        errors = {}
+        valid = []
+        for u_op, u_id in updates:
+            try:
+                self._check_update(u_op)
+                valid.append((u_op, u_id))
+            except Exception as e:
+                errors[u_id] = e
+
+        if not valid:
+            return [], errors
+
+        # The records are logged under rts_lock, so that gossip never sees a
+        # replica timestamp which covers a record not yet in the log
+        records = []
+        new_records = []
+        with self.rts_lock, self.log_lock:
+            for u_op, u_id in valid:
+                log_record = self.update_log.get((u_id, self._id))
+                if log_record is not None:
+                    records.append(log_record)
+                    u_prev = [max(p, t) for p, t in zip_longest(
+                        u_prev, log_record[1].value(), fillvalue=0)]
+                    continue
 
-            u_prev = VectorClock.fromiterable(u_prev)
-            log_record = (self._id, ts, u_op, u_prev, u_id)
-            with self.log_lock:
-                self.update_log.append(log_record)
+                self.replica_ts.increment(self._id)
+                ts = list(u_prev) + [0] * (self._id + 1 - len(u_prev))
+                ts[self._id] = self.replica_ts.entry(self._id)
+
+                log_record = (self._id, FrozenVectorClock.fromiterable(ts),
+                              u_op, FrozenVectorClock.fromiterable(u_prev),
+                              u_id)
+                self.update_log.add(log_record)
+                self._journal_record(log_record)
+                records.append(log_record)
+                new_records.append(log_record)
+                u_prev = ts
+            print('Replica timestamp: ', self.replica_ts, '\n')
+
+        # The updates are only acknowledged once they are on disk, so that
+        # their timestamps are never reused after a crash
+        self.store.wal.sync()
+
+        for log_record in new_records:
             print('Update record: ', log_record)
 
-            # Execute update if it is stable
-            with self.vts_lock:
-                if u_prev <= self.value_ts:  # stability criteria for query
-                    self._execute_update(u_op, u_id, ts)
+        # Other replica managers are now missing these updates
+        self.scheduler.notify()
+
+        # Execute the updates, and any they enable, if they are stable
+        with self.vts_lock:
+            for log_record in new_records:
+                self.pending.add(log_record, self.value_ts)
+            if wait:
+                errors.update(self._execute_stable_updates())
+
+        if not wait:
+            self.executor.notify()
+
+        return records, errors
+
+    def _check_update(self, u_op):
+        '''
+        Check that an update command can be executed, raising an exception
+        if not. Movies are never updated, so an update for a title that is
+        not found now will never succeed.
+
+        Params:
+            (string) u_op: update command to check
+        '''
+
+        op, userId, title, *_ = u_op
+        self._parse_u_op(op)
+        self.store.get_movie_by_title(title)
 
-            return ts.value()
+    def _execute_pending(self):
+        '''
+        Execute the pending updates that are stable. Run by the update
+        executor.
+        '''
 
-        return ts
+        with self.vts_lock:
+            self._execute_stable_updates()
 
     @Pyro4.oneway
     def send_gossip(self, m_log, m_ts, r_id):
@@ -456,7 +680,8 @@ class ReplicaManager(threading.Thread):
         Method invoked by other replica managers to send gossip.
 
         Params:
-            (string) m_log: recent updates from replica manager
+            (bytes) m_log:  recent updates from replica manager, encoded by
+                            encode_gossip
             (tuple) m_ts:   log timestamp of sending replica manager
             (string) r_id:  ID of sending replica manager
 
@@ -466,48 +691,160 @@ class ReplicaManager(threading.Thread):
         '''
 
         if self.status != Status.OFFLINE:
+            m_log = decode_gossip(m_log)
+
             print('\n--- RECEIVING GOSSIP ---')
             print(f'Gossip received from RM {r_id}')
             print(m_ts)
             print(m_log)
             print()
 
-            # Merge m_log into update log
-            self._merge_update_log(m_log)
+            # Merge m_log into update log. The new records are synced to disk
+            # before replica_ts shows they have been received, since peers
+            # may discard them once they have been received everywhere
+            new_records = self._merge_update_log(m_log)
+            self.store.wal.sync()
 
-            # Merge our replica timestamp with m_ts
+            # Merge our replica timestamp with m_ts. If we have updates the
+            # sender is missing, gossip back to it without waiting. The merged
+            # timestamp is journaled, since the records' timestamps alone do
+            # not show which updates have been received
             m_ts = VectorClock.fromiterable(m_ts)
             with self.rts_lock:
+                if not self.replica_ts <= m_ts:
+                    self.scheduler.notify(r_id)
                 self.replica_ts.merge(m_ts)
+                self.store.wal.append({'op': 'received',
+                                       'ts': self.replica_ts.value()})
                 print('Replica timestamp: ', self.replica_ts)
 
             # Execute all updates that have now become stable
-            stable = self._get_stable_updates()
-            for update in stable:
-                _id, ts, u_op, u_prev, u_id = update
-                with self.vts_lock:
-                    self._execute_update(u_op, u_id, ts)
+            with self.vts_lock:
+                for record in new_records:
+                    self.pending.add(record, self.value_ts)
+                self._execute_stable_updates()
 
             # Set the timestamp of the sending replica manager in our timestamp
-            # table
-            self.ts_table[r_id] = m_ts
+            # table, then discard records it shows every replica has received.
+            # A replica manager not yet known has joined, so is looked up
+            with self.peer_lock:
+                if r_id not in self.departed:
+                    if r_id not in self.ts_table:
+                        self.next_discovery = 0.0
+                    self.ts_table[r_id] = m_ts
+            self._collect_garbage()
 
-            # Execute all stable pending queries
-            while True:
-                try:
-                    q_op, q_prev = self.pending_queries.get(block=False)
+            print('------------------------')
 
-                    with self.vts_lock:
-                        if q_prev <= self.value_ts:
-                            val = self._apply_query(q_op)
-                            new = self.value_ts.value()
-                            self.query_results[(q_op, q_prev.value())].put(
-                                (val, new))
+    def add_member(self, r_id, r_ts):
+        '''
+        Method invoked by a replica manager when it starts, so that log
+        records are not discarded until it has received them.
 
-                except queue.Empty:
-                    break
+        Params:
+            (int) r_id:   ID of the replica manager
+            (tuple) r_ts: its replica timestamp
+        '''
 
-            print('------------------------')
+        with self.peer_lock:
+            self.departed.discard(r_id)
+            self.ts_table[r_id] = VectorClock.fromiterable(r_ts)
+
+        print(f'RM {r_id} has joined.')
+
+        # Look the replica manager up and gossip to it straight away
+        self.next_discovery = 0.0
+        self.scheduler.notify()
+
+    def remove_member(self, r_id):
+        '''
+        Method invoked by a replica manager leaving the system. It is no
+        longer sent gossip, or waited for before log records are discarded.
+
+        Params:
+            (int) r_id: ID of the replica manager
+        '''
+
+        with self.peer_lock:
+            self.departed.add(r_id)
+            self.ts_table.pop(r_id, None)
+            rm = self.peers.pop(r_id, None)
+        if rm is not None:
+            rm._pyroRelease()
+
+        print(f'RM {r_id} has left.')
+        self._collect_garbage()
+
+    def leave(self):
+        '''
+        Method invoked by status_control.py to remove the replica manager
+        from the system. The log records the other replica managers are
+        missing are sent to them, they are told to stop waiting for this
+        replica manager, and it goes offline, ready to be stopped.
+        '''
+
+        self.auto_status = False
+        self.status = Status.OFFLINE
+
+        with self.peer_lock:
+            peers = dict(self.peers)
+            table = {r_id: self.ts_table.get(r_id, VectorClock(0))
+                     for r_id in peers}
+
+        with self.rts_lock:
+            m_ts = self.replica_ts.value()
+            messages = [(r_id, self._get_recent_updates(table[r_id]))
+                        for r_id in peers]
+        self.store.wal.sync()
+
+        for r_id, m_log in messages:
+            try:
+                peers[r_id].send_gossip(encode_gossip(m_log), m_ts, self._id)
+                peers[r_id].remove_member(self._id)
+                print(f'Left RM {r_id}.')
+            except Pyro4.errors.CommunicationError:
+                print(f'Could not reach RM {r_id} to leave it.')
+
+    def open_transfer(self):
+        '''
+        Method invoked by a replica manager bootstrapping from this one, to
+        start a transfer of a snapshot of the data and gossip state.
+
+        Returns:
+            transfer: dictionary with the transfer ID, and the size, number
+                      of chunks and checksum of the snapshot
+        '''
+
+        data = self.store.snapshot(self.store_lock.reader, self._save_state)
+        self.store.wal.sync()   # as for gossip, the records must be on disk
+        return self.transfers.open(data)
+
+    def read_transfer(self, t_id, index):
+        '''
+        Method invoked by a replica manager bootstrapping from this one, to
+        read a chunk of a snapshot.
+
+        Params:
+            (string) t_id: ID of the transfer
+            (int) index:   index of the chunk
+
+        Returns:
+            chunk:    bytes of the snapshot
+            checksum: CRC32 of the chunk
+        '''
+
+        return self.transfers.read(t_id, index)
+
+    def close_transfer(self, t_id):
+        '''
+        Method invoked by a replica manager bootstrapping from this one, once
+        it has read every chunk of a snapshot.
+
+        Params:
+            (string) t_id: ID of the transfer
+        '''
+
+        self.transfers.close(t_id)
 
     def get_status(self):
         '''
@@ -519,6 +856,66 @@ class ReplicaManager(threading.Thread):
 
         return self.status.value
 
+    def get_load(self):
+        '''
+        Method invoked by front end to decide which replica manager to send
+        requests to. Also returned with every response.
+
+        Returns:
+            load: dictionary of the status, number of requests being handled,
+                  number of queries and updates waiting, 95th percentile
+                  latency of recent requests and value timestamp
+        '''
+
+        return {
+            'status': self.status.value,
+            'in_flight': self.load.in_flight,
+            'queue_depth': len(self.waiters) + len(self.pending),
+            'p95': self.load.p95(),
+            'value_ts': self.value_ts.value()
+        }
+
+    def get_value_ts(self):
+        '''
+        Method invoked by front end to check whether a cached query result
+        is still up to date.
+
+        Returns:
+            value timestamp of the replica manager
+        '''
+
+        return self.value_ts.value()
+
+    def get_metrics(self):
+        '''
+        Method invoked by status_control.py to get the sizes of the replica
+        manager's logs, the log size before and after the last garbage
+        collection, and the query cache statistics.
+
+        Returns:
+            metrics: dictionary of metric names and values
+        '''
+
+        with self.vts_lock, self.log_lock:
+            metrics = {
+                'update_log': len(self.update_log),
+                'executed': len(self.executed),
+                'pending_updates': len(self.pending),
+                'waiting_queries': len(self.waiters),
+                'gc_runs': self.gc_stats['runs'],
+                'gc_discarded': self.gc_stats['discarded'],
+                'gc_log_before': self.gc_stats['log_before'],
+                'gc_log_after': self.gc_stats['log_after'],
+                'anti_entropy_rounds': self.ae_stats['rounds'],
+                'anti_entropy_buckets': self.ae_stats['buckets'],
+                'anti_entropy_repaired': self.ae_stats['repaired']
+            }
+
+        for name, value in self.cache.stats().items():
+            metrics[f'cache_{name}'] = value
+
+        return metrics
+
     def set_status(self, status):
         '''
         Method invoked by status_control.py to set the server status.
@@ -554,7 +951,9 @@ class ReplicaManager(threading.Thread):
 
     def _apply_query(self, q_op):
         '''
-        Execute a query command.
+        Execute a query command, or return its cached result. Must be called
+        while holding the read side of store_lock, so that a result is never
+        cached after an update that invalidates it.
 
         Params:
             (string) q_op: query command to execute
@@ -567,24 +966,35 @@ class ReplicaManager(threading.Thread):
         val = None
 
         op, *params = q_op
+        key = (op, *params)
+        found, val = self.cache.get(key)
+        if found:
+            return val
+
         query = self._parse_q_op(op)
         val = query(*params)
+        self.cache.put(key, val, self._query_deps(op, params))
 
         return val
 
-    def _apply_update(self, u_op):
+    def _apply_update(self, u_op, journal=None):
         '''
         Execute an update command.
 
         Params:
-            (string) u_op: update command to execute
+            (string) u_op:    update command to execute
+            (dict) journal:   ID and timestamp of the update, written to the
+                              store's log with the change it makes
         '''
 
         print('Update applied.', u_op, '\n')
 
         op, *params = u_op
         update = self._parse_u_op(op)
-        update(*params)
+        try:
+            update(*params, journal)
+        finally:
+            self.cache.invalidate(self._update_deps(op, params))
 
     def _execute_update(self, u_op, u_id, ts):
         '''
@@ -596,50 +1006,259 @@ class ReplicaManager(threading.Thread):
             (VectorClock) ts: timestamp of update to execute
         '''
 
-        # Return immediately if update has already been executed
+        # An update accepted by two replica managers has a record from each.
+        # Once one has been executed, the other's timestamp is only merged,
+        # since updates which depend on it wait for it
         if u_id in self.executed:
+            with self.store_lock.writer:
+                self.value_ts.merge(ts)
+                self.store.wal.append({'op': 'executed', 'u_id': u_id,
+                                       'ts': ts.value()})
+            self.waiters.advance(self.value_ts)
             return
 
-        self._apply_update(u_op)  # Execute the update
-        self.value_ts.merge(ts)  # Update the value timestamp
-        self.executed.append(u_id)  # Add update to executed updates
+        journal = {'u_id': u_id, 'ts': ts.value()}
+        with self.store_lock.writer:
+            try:
+                self._apply_update(u_op, journal)  # Execute the update
+            except Exception:
+                # A failed update made no change, so it is journaled alone
+                self.store.wal.append({'op': 'executed', **journal})
+                raise
+            finally:
+                # An update which fails (e.g. for an unknown title) is still
+                # executed, so that updates which depend on it are not blocked
+                self.value_ts.merge(ts)  # Update the value timestamp
+                self.executed.add(u_id)  # Add update to executed updates
+        self.waiters.advance(self.value_ts)  # Wake now stable queries
         print('Value timestamp: ', self.value_ts)
 
-    def _merge_update_log(self, m_log):
+    def _execute_stable_updates(self):
         '''
-        Merge the update log with updates from a gossip message.
+        Execute pending updates in causal order until none are stable. Must
+        be called while holding vts_lock.
 
-        Params:
-            m_log: list of updates from a gossip message
+        Returns:
+            errors: dictionary of exceptions raised by updates, by update ID
         '''
 
-        for record in m_log:
+        errors = {}
+        record = self.pending.pop_stable(self.value_ts)
+        while record is not None:
             _id, ts, u_op, u_prev, u_id = record
-            ts = VectorClock.fromiterable(ts)
-            u_prev = VectorClock.fromiterable(u_prev)
-            with self.rts_lock, self.log_lock:
-                new_record = (_id, ts, u_op, u_prev, u_id)
-                if new_record not in self.update_log:
-                    if not ts <= self.replica_ts:
-                        self.update_log.append(new_record)
+            try:
+                self._execute_update(u_op, u_id, ts)
+            except Exception as e:
+                print(f'Update {u_id} failed: ', e)
+                errors[u_id] = e
+            record = self.pending.pop_stable(self.value_ts)
 
-    def _get_stable_updates(self):
+        return errors
+
+    def _save_state(self):
         '''
-        Retrieve all stable updates from the update log.
+        Get the gossip state to save with a snapshot of the store. Called by
+        the compactor while holding the read side of store_lock, so value_ts
+        and executed match the contents of the store.
 
         Returns:
-            stable: list of updates that can be executed.
+            state: dictionary of the timestamps, executed update IDs and the
+                   update log, encoded by encode_gossip
+        '''
+
+        with self.peer_lock:
+            ts_table = [[r_id, r_ts.value()]
+                        for r_id, r_ts in self.ts_table.items()]
+            departed = list(self.departed)
+
+        with self.rts_lock, self.log_lock:
+            log = [(_id, ts.value(), u_op, u_prev.value(), u_id)
+                   for _id, ts, u_op, u_prev, u_id in self.update_log]
+            return {
+                'id': self._id,
+                'value_ts': self.value_ts.value(),
+                'replica_ts': self.replica_ts.value(),
+                'ts_table': ts_table,
+                'departed': departed,
+                'executed': list(self.executed),
+                'log': encode_gossip(log)
+            }
+
+    def _journal_record(self, record):
+        '''
+        Write an update log record to the store's write-ahead log, so that
+        it is recovered after a crash. Must be called while holding log_lock.
+
+        Params:
+            (tuple) record: update log record
         '''
 
-        stable = []
+        _id, ts, u_op, u_prev, u_id = record
+        self.store.wal.append({'op': 'log', 'record': [
+            _id, ts.value(), u_op, u_prev.value(), u_id]})
+
+    def _restore_state(self, state, journal):
+        '''
+        Restore the gossip state saved with the snapshot the store was loaded
+        from, then replay the records logged and updates executed since, as
+        journaled in the store's write-ahead log. Logged updates which had
+        not been executed are pending again, and updates made since by other
+        replica managers are received by gossip as usual.
+
+        A replica manager's data folder may be seeded with a copy of that
+        of another, in which case it starts from the other's state. The
+        other's timestamp table still holds for the rest, and the other has
+        received everything in the copy.
+
+        Params:
+            (dict) state:   state returned by _save_state, or None if the
+                            store was loaded from the CSV files
+            (list) journal: entries journaled in the write-ahead log since
+        '''
+
+        records = []
+        if state is not None:
+            self.value_ts = VectorClock.fromiterable(state['value_ts'])
+            self.replica_ts = VectorClock.fromiterable(state['replica_ts'])
+            self.executed = set(state['executed'])
+            records = decode_gossip(state['log'])
+
+            if 'id' in state:
+                for r_id, r_ts in state['ts_table']:
+                    if r_id != self._id:
+                        self.ts_table[r_id] = VectorClock.fromiterable(r_ts)
+                if state['id'] != self._id:
+                    print(f'Seeded with the state of RM {state["id"]}.')
+                    self.ts_table[state['id']] = VectorClock.fromiterable(
+                        state['replica_ts'])
+                self.departed = set(state['departed']) - {self._id}
+                for r_id in self.departed:
+                    self.ts_table.pop(r_id, None)
+
+        executed = [self.value_ts.value()]
+        received = [self.replica_ts.value()]
+        for entry in journal:
+            if entry['op'] == 'log':
+                records.append(entry['record'])
+            elif entry['op'] == 'executed':
+                self.executed.add(entry['u_id'])
+                executed.append(entry['ts'])
+            elif entry['op'] == 'received':
+                received.append(entry['ts'])
+
+        # A record's timestamp also covers updates its client had seen, which
+        # may not have been received here, so only this replica manager's own
+        # entry is taken from the records it accepted. The entries of others
+        # come from the timestamps merged from gossip
+        accepted = 0
+        for _id, ts, u_op, u_prev, u_id in records:
+            record = (_id, FrozenVectorClock.fromiterable(ts), tuple(u_op),
+                      FrozenVectorClock.fromiterable(u_prev), u_id)
+            if self.update_log.add(record) and _id == self._id:
+                accepted = max(accepted, ts[self._id])
+        received.append([0] * self._id + [accepted])
+
+        # The timestamps are merged in one pass, rather than record by record.
+        # Every executed update has been received
+        self.value_ts = VectorClock.fromiterable(
+            [max(col) for col in zip_longest(*executed, fillvalue=0)])
+        self.replica_ts = VectorClock.fromiterable(
+            [max(col) for col in zip_longest(*received, self.value_ts.value(),
+                                             fillvalue=0)])
+        # IDs of updates whose records were discarded by garbage collection
+        # are journaled as executed, but are pruned again as they were then
+        self.executed = {u_id for u_id in self.executed
+                         if self.update_log.has_update(u_id)}
+
+        # With write-behind, a record may be covered by value_ts through the
+        # timestamps of other updates before it has been executed itself. A
+        # record of an executed update from another replica manager still
+        # has its timestamp to merge
+        for record in self.update_log:
+            if (record[4] not in self.executed or
+                    not record[1] <= self.value_ts):
+                self.pending.add(record, self.value_ts)
+
+        print('Restored state: ', self.value_ts, self.replica_ts,
+              f'{len(self.update_log)} logged updates,',
+              f'{len(journal)} journaled since snapshot')
+
+    def _collect_garbage(self):
+        '''
+        Discard update log records which have been executed here and are
+        known, from the timestamp table, to have been received by every other
+        replica manager. The IDs of discarded updates are removed from the
+        executed set once no record of them is left, since the records can no
+        longer be received again.
+        '''
+
+        with self.peer_lock:
+            peers = list(self.ts_table.values())
 
         with self.vts_lock, self.log_lock:
-            stable = [record for record in self.update_log
-                      if record[3] <= self.value_ts]
+            before = len(self.update_log)
+            discarded = [(record[4], record[0]) for record in
+                         self.update_log.received(peers)
+                         if record[4] in self.executed and
+                         record[1] <= self.value_ts and
+                         (record[4], record[0]) not in self.pending]
+            self.update_log.remove(discarded)
+            self.executed.difference_update(
+                u_id for u_id, _id in discarded
+                if not self.update_log.has_update(u_id))
+            after = len(self.update_log)
+
+            self.gc_stats['runs'] += 1
+            self.gc_stats['discarded'] += before - after
+            self.gc_stats['log_before'] = before
+            self.gc_stats['log_after'] = after
+
+        if before != after:
+            print(f'Update log garbage collected: {before} -> {after}')
+
+    def _merge_update_log(self, m_log):
+        '''
+        Merge the update log with updates from a gossip message.
+
+        Params:
+            m_log: list of updates from a gossip message
+
+        Returns:
+            new_records: list of records added to the update log
+        '''
+
+        new_records = []
+        with self.rts_lock, self.log_lock:
+            received = covered([record[1] for record in m_log],
+                               self.replica_ts)
+            for record, seen in zip(m_log, received):
+                _id, ts, u_op, u_prev, u_id = record
+                if seen or (u_id, _id) in self.update_log:
+                    continue
+                new_record = (_id, FrozenVectorClock.fromiterable(ts), u_op,
+                              FrozenVectorClock.fromiterable(u_prev), u_id)
+                self.update_log.add(new_record)
+                self._journal_record(new_record)
+                new_records.append(new_record)
+
+        return new_records
+
+    def _announce(self):
+        '''
+        Tell the other replica managers that this one has started, with its
+        replica timestamp, so that they keep the log records it is missing
+        until it has received them.
+        '''
 
-        stable.sort(key=lambda r: r[3])
+        self._refresh_replicas()
+        with self.peer_lock:
+            peers = dict(self.peers)
 
-        return stable
+        for r_id, rm in peers.items():
+            try:
+                rm.add_member(self._id, self.replica_ts.value())
+            except Pyro4.errors.CommunicationError:
+                print(f'Could not reach RM {r_id} to join it.')
 
     def _get_recent_updates(self, r_ts):
         '''
@@ -655,22 +1274,60 @@ class ReplicaManager(threading.Thread):
                     given timestamp
         '''
 
-        recent = []
+        # A replica manager which has received an update has received every
+        # update its origin accepted before it, so the records it is missing
+        # are those whose origin's entry is greater than its own
         with self.log_lock:
-            for record in self.update_log:
-                _id, ts, u_op, u_prev, u_id = record
-                if ts > r_ts:
-                    new_record = (_id, ts.value(), u_op, u_prev.value(), u_id)
-                    recent.append(new_record)
+            recent = [(_id, ts.value(), u_op, u_prev.value(), u_id)
+                      for _id, ts, u_op, u_prev, u_id
+                      in self.update_log.since(r_ts)]
 
         return recent
 
+    def _refresh_replicas(self):
+        '''
+        Look up the other replica managers with the name server, keeping the
+        existing proxy for any whose URI has not changed.
+
+        Returns:
+            new: list of IDs of replica managers not previously known
+        '''
+
+        found = self._find_replicas()
+        self.next_discovery = time.monotonic() + self.discovery_interval
+        if found is None:
+            return []
+
+        # Replica managers which have left, but not yet stopped, are ignored
+        new = []
+        with self.peer_lock:
+            found = [(r_id, uri) for r_id, uri in found
+                     if r_id not in self.departed]
+            for r_id, uri in found:
+                self.ts_table.setdefault(r_id, VectorClock(0))
+                rm = self.peers.get(r_id)
+                if rm is not None and rm._pyroUri == uri:
+                    continue
+                if rm is not None:
+                    rm._pyroRelease()
+
+                rm = Pyro4.Proxy(uri)
+                rm._pyroTimeout = self.gossip_timeout
+                self.peers[r_id] = rm
+                new.append(r_id)
+
+            for r_id in set(self.peers) - {r_id for r_id, uri in found}:
+                self.peers.pop(r_id)._pyroRelease()
+
+        return new
+
     def _find_replicas(self):
         '''
         Find all online replica managers.
 
         Returns:
-            servers: list of remote server objects for replica managers
+            servers: list of (ID, URI) for other replica managers, or None if
+                     the name server could not be found
         '''
 
         servers = []
@@ -679,14 +1336,14 @@ class ReplicaManager(threading.Thread):
                 for server, uri in ns.list(prefix="network.replica.").items():
                     server_id = int(server.split('.')[-1])
                     if server_id != self._id:
-                        servers.append((server_id, Pyro4.Proxy(uri)))
+                        servers.append((server_id, Pyro4.URI(uri)))
         except Pyro4.errors.NamingError:
             print('Could not find Pyro nameserver.')
+            return None
         servers.sort()
-        return servers[:REPLICA_NUM]
+        return servers
 
-    @staticmethod
-    def _parse_q_op(op):
+    def _parse_q_op(self, op):
         '''
         Match query command strings with query functions.
 
@@ -698,18 +1355,74 @@ class ReplicaManager(threading.Thread):
         '''
 
         return {
-            ROp.GET_AVG_RATING.value: get_avg_movie_rating,
-            ROp.GET_RATINGS.value: get_movie_ratings,
-            ROp.GET_GENRES.value: get_movie_genres,
-            ROp.GET_MOVIE.value: get_movie_by_title,
-            ROp.GET_TAGS.value: get_movie_tags,
-            ROp.SEARCH_TITLE.value: search_by_title,
-            ROp.SEARCH_GENRE.value: search_by_genre,
-            ROp.SEARCH_TAG.value: search_by_tag
+            ROp.GET_AVG_RATING.value: self.store.get_avg_movie_rating,
+            ROp.GET_RATING_STATS.value: self.store.get_rating_stats,
+            ROp.GET_RATINGS.value: self.store.get_movie_ratings,
+            ROp.GET_RATINGS_PAGE.value: self.store.get_movie_ratings_page,
+            ROp.GET_GENRES.value: self.store.get_movie_genres,
+            ROp.GET_MOVIE.value: self.store.get_movie_by_title,
+            ROp.GET_TAGS.value: self.store.get_movie_tags,
+            ROp.SEARCH_TITLE.value: self.store.search_by_title,
+            ROp.SEARCH_GENRE.value: self.store.search_by_genre,
+            ROp.SEARCH_TAG.value: self.store.search_by_tag
         }[op]
 
-    @staticmethod
-    def _parse_u_op(op):
+    def _query_deps(self, op, params):
+        '''
+        Find the parts of the data that the result of a query depends on.
+        Movies are never updated, so queries on movies alone depend on
+        nothing.
+
+        Params:
+            (string) op:  query command
+            (list) params: arguments of the query command
+
+        Returns:
+            deps: set of dependency tags, matching those of _update_deps
+        '''
+
+        if op in (ROp.GET_AVG_RATING.value, ROp.GET_RATING_STATS.value):
+            title, = params
+            return {('ratings', self.store.titles.get(title.lower()))}
+
+        if op in (ROp.GET_RATINGS.value, ROp.GET_RATINGS_PAGE.value):
+            userId, title, *_ = params + [None, None]
+            if userId:
+                return {('user', userId)}
+            if title:
+                return {('ratings', self.store.titles.get(title.lower()))}
+            return {('ratings',)}
+
+        if op == ROp.GET_TAGS.value:
+            title, = params
+            return {('tags', self.store.titles.get(title.lower()))}
+
+        if op == ROp.SEARCH_TAG.value:
+            return {('tags',)}
+
+        return set()
+
+    def _update_deps(self, op, params):
+        '''
+        Find the parts of the data that an update command changes.
+
+        Params:
+            (string) op:   update command
+            (list) params: arguments of the update command
+
+        Returns:
+            deps: set of dependency tags, matching those of _query_deps
+        '''
+
+        userId, title, _ = params
+        movieId = self.store.titles.get(title.lower())
+
+        if op == ROp.ADD_RATING.value:
+            return {('ratings', movieId), ('user', userId), ('ratings',)}
+
+        return {('tags', movieId), ('tags',)}
+
+    def _parse_u_op(self, op):
         '''
         Match update command strings with update functions.
 
@@ -721,8 +1434,8 @@ class ReplicaManager(threading.Thread):
         '''
 
         return {
-            ROp.ADD_RATING.value: submit_rating,
-            ROp.ADD_TAG.value: submit_tag
+            ROp.ADD_RATING.value: self.store.submit_rating,
+            ROp.ADD_TAG.value: self.store.submit_tag
         }[op]
 
 
@@ -731,29 +1444,49 @@ if __name__ == '__main__':
     NAME = None
     STATUS = None
     REPLICADIR = None
+    BOOTSTRAP = False   # whether to start from a snapshot of another replica
+    BOOTSTRAP_FROM = None   # ID of the replica manager to bootstrap from
+
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+    options = [arg for arg in argv[1:] if arg.startswith('--')]
 
-    if len(argv) < 2:
+    if len(args) < 1:
         print('No server ID provided, exiting.')
         exit()
 
     try:
-        ID = int(argv[1])
+        ID = int(args[0])
         NAME = f'network.replica.{ID}'
         REPLICADIR = f'replica_{ID}/'
-        STATUS = argv[2]
+        STATUS = args[1]
     except ValueError:
         print('Invalid server ID provided, exiting.')
         exit()
     except IndexError:
         pass
 
+    for option in options:
+        name, _, value = option.partition('=')
+        if name != '--bootstrap' or value and not value.isdigit():
+            print(f'Invalid option {option} provided, exiting.')
+            exit()
+        BOOTSTRAP = True
+        BOOTSTRAP_FROM = int(value) if value else None
+
     this_dir = os.path.abspath(__file__)
+    if BOOTSTRAP:
+        os.makedirs(f'{os.path.dirname(this_dir)}/{REPLICADIR}', exist_ok=True)
     os.chdir(f'{os.path.dirname(this_dir)}/{REPLICADIR}')
     path.append(os.path.dirname(path[0]))
 
-    from signalhandler import SignalHandler
-    from vectorclock import VectorClock
-    from enums import Status, ROp
+    import_modules()
+
+    if BOOTSTRAP:
+        try:
+            bootstrap(ID, BOOTSTRAP_FROM)
+        except (ValueError, Pyro4.errors.PyroError) as e:
+            print(f'Could not bootstrap: {e}')
+            exit()
 
     stopper = threading.Event()
     daemon = Pyro4.Daemon()
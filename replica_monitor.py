@@ -0,0 +1,155 @@
+import threading
+import time
+import Pyro4
+from concurrent.futures import ThreadPoolExecutor
+from enums import Status
+from vectorclock import VectorClock
+
+
+class ReplicaMonitor(threading.Thread):
+    '''
+    Background thread that keeps a table of the replica managers and their
+    load reports for the front end, so that a replica manager can be chosen
+    without any remote calls on the request path. The table is refreshed
+    periodically by polling the replica managers in parallel, and is kept
+    up to date in between with the load reports returned with every
+    response.
+    '''
+
+    def __init__(self, stopper, max_replicas, policy, interval=2.0,
+                 discovery_interval=10.0, timeout=1.0):
+        super().__init__(daemon=True)
+
+        self.stopper = stopper
+        self.max_replicas = max_replicas    # replicas polled at once
+        self.policy = policy    # routing policy choosing between replicas
+        self.interval = interval    # interval between load polls
+        self.discovery_interval = discovery_interval    # between lookups
+        self.timeout = timeout      # timeout for polling a replica manager
+
+        self.replicas = {}      # URI -> load report, or None if unreachable
+        self._proxies = {}      # URI -> proxy owned by the monitor thread
+        self._lock = threading.Lock()
+        self._refreshed = threading.Event()     # set after the first poll
+        self._next_discovery = 0.0
+
+    def run(self):
+        '''
+        Override of threading.Thread run() method. Refreshes the replica
+        table every interval seconds.
+        '''
+
+        with ThreadPoolExecutor(max_workers=self.max_replicas) as pool:
+            while not self.stopper.is_set():
+                self.refresh(pool)
+                self.stopper.wait(self.interval)
+
+        for proxy in self._proxies.values():
+            proxy._pyroRelease()
+
+    def refresh(self, pool):
+        '''
+        Look up the replica managers if due, and poll their loads.
+
+        Params:
+            (Executor) pool: thread pool to poll the replica managers with
+        '''
+
+        if time.monotonic() >= self._next_discovery or not self._proxies:
+            self._discover()
+
+        uris = list(self._proxies)
+        loads = pool.map(self._poll, [self._proxies[u] for u in uris])
+        with self._lock:
+            self.replicas = dict(zip(uris, loads))
+        self._refreshed.set()
+
+    def report(self, uri, load):
+        '''
+        Record the load of a replica manager, as returned with a response or
+        None if it could not be reached.
+
+        Params:
+            (URI) uri:   URI of the replica manager
+            (dict) load: load report of the replica manager, or None
+        '''
+
+        with self._lock:
+            if uri in self.replicas:
+                self.replicas[uri] = load
+
+    def choose(self, ts=None, exclude=None):
+        '''
+        Select a replica manager to send a request to. 'Active' replica
+        managers are preferred, but an 'overloaded' one will be chosen if
+        there are no 'active' ones. Of those, replica managers which have
+        executed every update the session has seen are preferred, so that
+        queries do not have to wait, and the routing policy chooses between
+        the rest.
+
+        Params:
+            (tuple) ts:    vector timestamp of the session
+            (URI) exclude: URI of a replica manager to avoid choosing, unless
+                           it is the only one available
+
+        Returns:
+            uri: URI of the chosen replica manager
+        '''
+
+        # Wait for the first poll if the front end has only just started
+        self._refreshed.wait(self.timeout * 2)
+
+        with self._lock:
+            stat = dict(self.replicas)
+
+        if not stat:
+            raise ValueError(
+                "No servers found! (are the movie servers running?)"
+            )
+
+        status = {u: load and load['status'] for u, load in stat.items()}
+        active = [u for u, s in status.items() if s == Status.ACTIVE.value]
+        available = active or [u for u, s in status.items()
+                               if s == Status.OVERLOADED.value]
+        if not available:
+            raise Exception('All servers offline')
+
+        available = [u for u in available if u != exclude] or available
+        if ts is not None:
+            ts = VectorClock.fromiterable(ts)
+            available = [u for u in available
+                         if ts <= VectorClock.fromiterable(
+                             stat[u]['value_ts'])] or available
+
+        return self.policy.choose({u: stat[u] for u in available})
+
+    def _discover(self):
+        '''
+        Find all online replica managers, keeping the existing proxy for any
+        whose URI has not changed.
+        '''
+
+        self._next_discovery = time.monotonic() + self.discovery_interval
+        try:
+            with Pyro4.locateNS() as ns:
+                found = sorted(ns.list(prefix="network.replica.").items())
+        except Pyro4.errors.NamingError:
+            print('Could not find Pyro nameserver.')
+            return
+
+        uris = [Pyro4.URI(uri) for _, uri in found]
+        for uri in set(self._proxies) - set(uris):
+            self._proxies.pop(uri)._pyroRelease()
+        for uri in uris:
+            if uri not in self._proxies:
+                print("found replica", uri)
+                proxy = Pyro4.Proxy(uri)
+                proxy._pyroTimeout = self.timeout
+                self._proxies[uri] = proxy
+
+    @staticmethod
+    def _poll(proxy):
+        try:
+            return proxy.get_load()
+        except Pyro4.errors.CommunicationError:
+            return None
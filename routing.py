@@ -0,0 +1,99 @@
+import random
+
+
+def load_score(load):
+    '''
+    Estimate how long a request sent to a replica manager would take, from
+    the load it last reported: the requests ahead of it, each taking about
+    the recent 95th percentile latency.
+
+    Params:
+        (dict) load: load report of a replica manager
+
+    Returns:
+        (float) score: estimated latency, lower is better
+    '''
+
+    waiting = load['in_flight'] + load['queue_depth'] + 1
+    return waiting * max(load['p95'], 0.001)
+
+
+class RoutingPolicy:
+    '''
+    Base class of the policies a front end uses to choose which of the
+    available replica managers to send a request to.
+    '''
+
+    name = None
+
+    def choose(self, candidates):
+        '''
+        Choose a replica manager.
+
+        Params:
+            (dict) candidates: URI -> load report of each available replica
+                               manager, of which there is at least one
+
+        Returns:
+            uri: URI of the chosen replica manager
+        '''
+
+        raise NotImplementedError
+
+
+class RandomPolicy(RoutingPolicy):
+    '''
+    Choose uniformly at random, ignoring load.
+    '''
+
+    name = 'random'
+
+    def choose(self, candidates):
+        return random.choice(list(candidates))
+
+
+class LeastLoadedPolicy(RoutingPolicy):
+    '''
+    Choose the replica manager with the lowest load score. Since every front
+    end sees the same reports, this can send bursts from several front ends
+    to the same replica manager.
+    '''
+
+    name = 'least-loaded'
+
+    def choose(self, candidates):
+        return min(candidates, key=lambda uri: load_score(candidates[uri]))
+
+
+class PowerOfTwoPolicy(RoutingPolicy):
+    '''
+    Choose the less loaded of two replica managers picked at random, which
+    spreads load almost as well as least-loaded without every front end
+    converging on the same replica manager.
+    '''
+
+    name = 'p2c'
+
+    def choose(self, candidates):
+        pair = random.sample(list(candidates), min(2, len(candidates)))
+        return min(pair, key=lambda uri: load_score(candidates[uri]))
+
+
+class FreshestPolicy(RoutingPolicy):
+    '''
+    Choose the replica manager which has executed the most updates, so that
+    queries are least likely to wait for updates, breaking ties by load.
+    '''
+
+    name = 'freshest'
+
+    def choose(self, candidates):
+        return min(candidates,
+                   key=lambda uri: (-sum(candidates[uri]['value_ts']),
+                                    load_score(candidates[uri])))
+
+
+POLICIES = {policy.name: policy for policy in
+            [RandomPolicy, LeastLoadedPolicy, PowerOfTwoPolicy,
+             FreshestPolicy]}
+DEFAULT_POLICY = PowerOfTwoPolicy.name
@@ -0,0 +1,63 @@
+import threading
+
+
+class RWLock:
+    '''
+    Readers-writer lock. Any number of readers may hold the lock at once,
+    while a writer holds it exclusively. Waiting writers are preferred over
+    new readers, so that a steady stream of queries cannot starve updates.
+
+    The reader and writer attributes can be used like ordinary locks, e.g.
+    "with lock.reader:".
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0           # number of readers holding the lock
+        self._writer = False        # whether a writer holds the lock
+        self._writers_waiting = 0
+
+        self.reader = _Side(self.acquire_read, self.release_read)
+        self.writer = _Side(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class _Side:
+    '''
+    Context manager for one side (reading or writing) of an RWLock.
+    '''
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
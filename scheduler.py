@@ -0,0 +1,91 @@
+import threading
+import time
+
+
+class GossipScheduler:
+    '''
+    Decides when a replica manager should next send gossip to each of its
+    peers. Gossip is sent soon after a peer is known to be missing updates,
+    either because new updates have been received or because a query is
+    waiting on updates from elsewhere, and the interval backs off
+    exponentially while there is nothing to exchange with the peer.
+    '''
+
+    def __init__(self, min_interval=0.5, max_interval=8.0, debounce=0.05):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.debounce = debounce    # delay to batch notifications together
+        self.tick = 0.25            # longest wait between stopper checks
+
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._due = {}          # peer ID -> time gossip is next due
+        self._interval = {}     # peer ID -> current gossip interval
+
+    def notify(self, r_id=None):
+        '''
+        Make gossip due immediately, after a short debounce.
+
+        Params:
+            (int) r_id: ID of the peer to gossip to, or None for all peers
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            peers = self._due if r_id is None else [r_id]
+            for peer in peers:
+                self._due[peer] = now
+        self._event.set()
+
+    def wait(self, stopper, peers):
+        '''
+        Block until gossip is due to at least one peer, the longest interval
+        (or the shortest, if there are no peers) has passed, or the stopper
+        is set.
+
+        Params:
+            (Event) stopper: event set when the replica manager is stopping
+            (list) peers:    IDs of the peers currently known
+
+        Returns:
+            due: list of IDs of the peers that gossip is due to
+        '''
+
+        # With no peers known, return soon so that they can be looked for
+        interval = self.max_interval if peers else self.min_interval
+        deadline = time.monotonic() + interval
+        while not stopper.is_set():
+            now = time.monotonic()
+            with self._lock:
+                for peer in peers:
+                    self._due.setdefault(peer, now)
+                due = [peer for peer in peers if self._due[peer] <= now]
+                wake = min([self._due[peer] for peer in peers] + [deadline])
+
+            if due or now >= deadline:
+                return due
+
+            if self._event.wait(min(wake - now, self.tick)):
+                self._event.clear()
+                stopper.wait(self.debounce)
+
+        return []
+
+    def sent(self, r_id, n_records):
+        '''
+        Record that gossip has been sent to a peer, and schedule the next.
+
+        Params:
+            (int) r_id:      ID of the peer gossip was sent to
+            (int) n_records: number of update records sent to the peer
+        '''
+
+        with self._lock:
+            if n_records:
+                # The peer was lagging, so check back soon
+                interval = self.min_interval
+            else:
+                interval = min(self._interval.get(r_id, self.min_interval) * 2,
+                               self.max_interval)
+            self._interval[r_id] = interval
+            self._due[r_id] = time.monotonic() + interval
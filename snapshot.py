@@ -0,0 +1,273 @@
+import json
+import mmap
+import os
+import sys
+from array import array
+from tempfile import NamedTemporaryFile
+
+
+MAGIC = b'MVSNAP01'
+VERSION = 1
+ALIGN = 8   # sections start on multiples of this, so they can be cast
+
+# Typed columns of each table. String columns hold indexes into the string
+# table, in which string i is strings[offsets[i]:offsets[i + 1]]
+COLUMNS = {
+    'movies': [('movieId', 'i'), ('title', 'I'), ('genres', 'I')],
+    'ratings': [('userId', 'i'), ('movieId', 'i'), ('rating', 'd'),
+                ('timestamp', 'q')],
+    'tags': [('userId', 'i'), ('movieId', 'i'), ('tag', 'I'),
+             ('timestamp', 'q')]
+}
+STRING_COLUMNS = {('movies', 'title'), ('movies', 'genres'), ('tags', 'tag')}
+
+
+def save_snapshot(filename, tables, state):
+    '''
+    Atomically write a snapshot of a replica's data and gossip state.
+
+    Params:
+        (string) filename: file to write the snapshot to
+        (dict) tables:     table name -> list of row dictionaries, as read
+                           from the CSV files
+        (dict) state:      JSON serialisable gossip state, and the update
+                           log under 'log' as bytes
+    '''
+
+    write_snapshot(filename, encode_snapshot(tables, state))
+
+
+def write_snapshot(filename, data):
+    '''
+    Atomically write an encoded snapshot.
+
+    Params:
+        (string) filename: file to write the snapshot to
+        (bytes) data:      snapshot encoded by encode_snapshot
+    '''
+
+    tempfile = NamedTemporaryFile(mode='wb', dir='.', delete=False)
+    with tempfile:
+        tempfile.write(data)
+        tempfile.flush()
+        os.fsync(tempfile.fileno())
+    os.replace(tempfile.name, filename)
+
+
+def encode_snapshot(tables, state):
+    '''
+    Encode a snapshot of a replica's data and gossip state.
+
+    The snapshot starts with a magic number and a JSON header giving the
+    offset and length of each section, followed by the sections: a typed
+    array for each column of the movie, rating and tag tables, a string
+    table for the titles, genres and tags, and the update log encoded by
+    encode_gossip.
+
+    Params:
+        (dict) tables: table name -> list of row dictionaries, as read from
+                       the CSV files
+        (dict) state:  JSON serialisable gossip state, and the update log
+                       under 'log' as bytes
+
+    Returns:
+        (bytes) data: encoded snapshot
+    '''
+
+    strings = {}    # string -> index in string table
+
+    def intern(s):
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    sections = {}
+    for table, columns in COLUMNS.items():
+        rows = tables[table]
+        for name, typecode in columns:
+            if (table, name) in STRING_COLUMNS:
+                values = [intern(row[name]) for row in rows]
+            elif typecode == 'd':
+                values = [float(row[name]) for row in rows]
+            else:
+                values = [int(row[name]) for row in rows]
+            sections[f'{table}.{name}'] = array(typecode, values).tobytes()
+
+    encoded = [s.encode() for s in strings]
+    offsets = array('Q', [0])
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    sections['strings'] = b''.join(encoded)
+    sections['offsets'] = offsets.tobytes()
+
+    state = dict(state)
+    sections['log'] = state.pop('log')
+
+    layout = {}
+    position = 0
+    for name, data in sections.items():
+        layout[name] = [position, len(data)]
+        position += -(-len(data) // ALIGN) * ALIGN
+
+    header = json.dumps({
+        'version': VERSION,
+        'byteorder': sys.byteorder,
+        'rows': {table: len(tables[table]) for table in COLUMNS},
+        'sections': layout,
+        'state': state
+    }).encode()
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    parts = [MAGIC, len(header).to_bytes(8, 'little'), header,
+             bytes(start - len(MAGIC) - 8 - len(header))]
+    for data in sections.values():
+        parts += [data, bytes(-len(data) % ALIGN)]
+    return b''.join(parts)
+
+
+def load_snapshot(filename):
+    '''
+    Read a snapshot written by save_snapshot. The file is mapped into memory
+    and the columns are read directly from the mapping.
+
+    Params:
+        (string) filename: file to read the snapshot from
+
+    Returns:
+        tables: table name -> dictionary of column name -> list of values,
+                with the values of string columns as strings
+        state:  gossip state, and the update log under 'log' as bytes,
+                or None if there is no usable snapshot
+    '''
+
+    try:
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None, None
+
+    with mapped:
+        return decode_snapshot(mapped)
+
+
+def decode_snapshot(data):
+    '''
+    Decode a snapshot encoded by encode_snapshot. The columns are read
+    directly from the buffer holding it.
+
+    Params:
+        data: buffer holding the snapshot
+
+    Returns:
+        tables: table name -> dictionary of column name -> list of values,
+                with the values of string columns as strings
+        state:  gossip state, and the update log under 'log' as bytes,
+                or None if the snapshot is not usable
+    '''
+
+    header, start = _read_header(data)
+    if header is None:
+        return None, None
+
+    def section(name, typecode):
+        offset, size = header['sections'][name]
+        with memoryview(data) as view:
+            part = view[start + offset:start + offset + size]
+            with part, part.cast(typecode) as values:
+                return values.tolist() if typecode != 'B' else bytes(part)
+
+    offsets = section('offsets', 'Q')
+    blob = section('strings', 'B')
+    strings = [blob[offsets[i]:offsets[i + 1]].decode()
+               for i in range(len(offsets) - 1)]
+
+    tables = {}
+    for table, columns in COLUMNS.items():
+        tables[table] = {}
+        for name, typecode in columns:
+            values = section(f'{table}.{name}', typecode)
+            if (table, name) in STRING_COLUMNS:
+                values = [strings[i] for i in values]
+            tables[table][name] = values
+
+    state = header['state']
+    state['log'] = section('log', 'B')
+
+    return tables, state
+
+
+def replace_state(data, state):
+    '''
+    Replace the gossip state saved in an encoded snapshot, without encoding
+    its data again.
+
+    Params:
+        (bytes) data: snapshot encoded by encode_snapshot
+        (dict) state: JSON serialisable gossip state, without the update log
+
+    Returns:
+        (bytes) data: snapshot with the new state
+    '''
+
+    header, start = _read_header(data)
+    header['state'] = state
+    header = json.dumps(header).encode()
+    begin = len(MAGIC) + 8 + len(header)
+    return b''.join([MAGIC, len(header).to_bytes(8, 'little'), header,
+                     bytes(-begin % ALIGN), data[start:]])
+
+
+def snapshot_state(data):
+    '''
+    Read only the gossip state saved in an encoded snapshot.
+
+    Params:
+        (bytes) data: snapshot encoded by encode_snapshot
+
+    Returns:
+        state: gossip state, or None if the snapshot is not usable
+    '''
+
+    header, _ = _read_header(data)
+    return header and header['state']
+
+
+def load_snapshot_state(filename):
+    '''
+    Read only the gossip state saved in a snapshot, without its data or
+    update log.
+
+    Params:
+        (string) filename: file to read the snapshot from
+
+    Returns:
+        state: gossip state, or None if there is no usable snapshot
+    '''
+
+    try:
+        with open(filename, 'rb') as f:
+            begin = f.read(len(MAGIC) + 8)
+            length = int.from_bytes(begin[len(MAGIC):], 'little')
+            return snapshot_state(begin + f.read(length))
+    except FileNotFoundError:
+        return None
+
+
+def _read_header(data):
+    '''
+    Returns:
+        header: header of a snapshot, or None if it is not a usable snapshot
+        start:  position of the first section
+    '''
+
+    begin = len(MAGIC) + 8
+    if len(data) < begin or data[:len(MAGIC)] != MAGIC:
+        return None, 0
+
+    length = int.from_bytes(data[len(MAGIC):begin], 'little')
+    header = json.loads(bytes(data[begin:begin + length]))
+    if (header['version'] != VERSION or
+            header['byteorder'] != sys.byteorder):
+        return None, 0
+
+    return header, -(-(begin + length) // ALIGN) * ALIGN
@@ -0,0 +1,270 @@
+import base64
+import os
+import shutil
+import threading
+import time
+import uuid
+import zlib
+import Pyro4
+from enums import Status
+from journal import WriteAheadLog
+from moviestore import MovieStore, snapshot_file
+from snapshot import load_snapshot_state, snapshot_state
+
+
+CHUNK_SIZE = 2**20      # Bytes of a snapshot sent in each call
+STAGING_DIR = 'bootstrap'   # Folder a received snapshot is written to first
+COMPLETE_FILE = 'complete'  # Written once the staged files are complete
+
+
+class TransferSource:
+    '''
+    Snapshots being transferred to other replica managers. Each snapshot is
+    compressed and kept in memory until the transfer is closed or unused
+    for expiry seconds, so that every chunk of a transfer comes from the
+    same snapshot. Chunks are sent with a checksum, so a chunk corrupted on
+    the way is fetched again rather than installed.
+    '''
+
+    def __init__(self, chunk_size=CHUNK_SIZE, expiry=60.0):
+        self.chunk_size = chunk_size
+        self.expiry = expiry
+
+        self._transfers = {}    # transfer ID -> [data, time last read]
+        self._lock = threading.Lock()
+
+    def open(self, data):
+        '''
+        Start a transfer of a snapshot.
+
+        Params:
+            (bytes) data: snapshot encoded by encode_snapshot
+
+        Returns:
+            transfer: dictionary with the transfer ID, and the size, number
+                      of chunks and checksum of the compressed snapshot
+        '''
+
+        data = zlib.compress(data, 1)
+        t_id = str(uuid.uuid4())
+        now = time.monotonic()
+
+        with self._lock:
+            self._transfers = {t: transfer for t, transfer in
+                               self._transfers.items()
+                               if now - transfer[1] < self.expiry}
+            self._transfers[t_id] = [data, now]
+
+        return {
+            'id': t_id,
+            'size': len(data),
+            'chunks': -(-len(data) // self.chunk_size),
+            'checksum': zlib.crc32(data)
+        }
+
+    def read(self, t_id, index):
+        '''
+        Read a chunk of a transfer.
+
+        Params:
+            (string) t_id: ID of the transfer
+            (int) index:   index of the chunk
+
+        Returns:
+            chunk:    bytes of the compressed snapshot
+            checksum: CRC32 of the chunk
+        '''
+
+        with self._lock:
+            transfer = self._transfers.get(t_id)
+            if transfer is None:
+                raise ValueError(f'Unknown or expired transfer [ {t_id} ].')
+            transfer[1] = time.monotonic()
+
+        start = index * self.chunk_size
+        chunk = transfer[0][start:start + self.chunk_size]
+        return chunk, zlib.crc32(chunk)
+
+    def close(self, t_id):
+        with self._lock:
+            self._transfers.pop(t_id, None)
+
+
+def fetch_snapshot(rm, retries=3):
+    '''
+    Fetch a snapshot from a replica manager, chunk by chunk. A chunk whose
+    checksum does not match is fetched again, up to retries times.
+
+    Params:
+        (Proxy) rm: proxy of the replica manager
+
+    Returns:
+        (bytes) data: snapshot encoded by encode_snapshot
+
+    Raises:
+        ValueError: if the snapshot could not be fetched intact
+    '''
+
+    transfer = rm.open_transfer()
+    chunks = []
+    try:
+        for index in range(transfer['chunks']):
+            for _ in range(retries):
+                chunk, checksum = rm.read_transfer(transfer['id'], index)
+
+                # The serpent serializer used by Pyro transfers bytes as base64
+                if isinstance(chunk, dict):
+                    chunk = base64.b64decode(chunk['data'])
+                if zlib.crc32(chunk) == checksum:
+                    break
+            else:
+                raise ValueError(f'Chunk {index} of the snapshot was corrupt.')
+            chunks.append(chunk)
+    finally:
+        rm.close_transfer(transfer['id'])
+
+    data = b''.join(chunks)
+    if (len(data) != transfer['size'] or
+            zlib.crc32(data) != transfer['checksum']):
+        raise ValueError('The snapshot was corrupted in transfer.')
+
+    return zlib.decompress(data)
+
+
+def bootstrap(replica_id, peer_id=None, timeout=60.0):
+    '''
+    Replace the data and state of a replica manager, which must not be
+    running, with a snapshot of those of another. The other replica
+    manager is the one with the given ID, or else the online one which has
+    executed the most updates.
+
+    A replica manager's own updates cannot be received from any other, so
+    the snapshot is refused if it is missing any of them.
+
+    Params:
+        (int) replica_id: ID of the replica manager to bootstrap
+        (int) peer_id:    ID of the replica manager to fetch the snapshot
+                          from, or None to choose one
+        (float) timeout:  timeout for each call to the other replica manager
+
+    Raises:
+        ValueError: if no snapshot could be fetched and installed
+    '''
+
+    with Pyro4.locateNS() as ns:
+        found = ns.list(prefix='network.replica.')
+    uris = {int(name.split('.')[-1]): uri for name, uri in found.items()}
+    uris.pop(replica_id, None)
+    if peer_id is not None:
+        uris = {peer_id: uris[peer_id]} if peer_id in uris else {}
+
+    loads = {}
+    for r_id, uri in uris.items():
+        try:
+            with Pyro4.Proxy(uri) as rm:
+                rm._pyroTimeout = timeout
+                loads[r_id] = rm.get_load()
+        except Pyro4.errors.CommunicationError:
+            print(f'Could not reach RM {r_id}.')
+
+    online = [r_id for r_id, load in loads.items()
+              if load['status'] != Status.OFFLINE.value]
+    if not online:
+        raise ValueError('No replica manager to bootstrap from is online.')
+    peer_id = max(online, key=lambda r_id: sum(loads[r_id]['value_ts']))
+
+    print(f'Fetching snapshot from RM {peer_id}...')
+    start = time.monotonic()
+    with Pyro4.Proxy(uris[peer_id]) as rm:
+        rm._pyroTimeout = timeout
+        data = fetch_snapshot(rm)
+
+    state = snapshot_state(data)
+    if state is None:
+        raise ValueError(f'The snapshot of RM {peer_id} is not supported.')
+
+    replica_ts = state['replica_ts']
+    received = replica_ts[replica_id] if replica_id < len(replica_ts) else 0
+    if received < accepted(replica_id):
+        raise ValueError(f'RM {peer_id} has not received every update '
+                         f'accepted by RM {replica_id}. Start it without '
+                         'bootstrapping, so that they are gossiped first.')
+
+    install_snapshot(data)
+    print(f'Installed snapshot of RM {peer_id} ({len(data)} bytes) in '
+          f'{time.monotonic() - start:.1f}s:', tuple(state['value_ts']))
+
+
+def accepted(replica_id):
+    '''
+    Get the number of updates a replica manager has accepted, from the state
+    saved in its snapshot and the records journaled in its write-ahead log.
+
+    Params:
+        (int) replica_id: ID of the replica manager
+
+    Returns:
+        (int) its entry of its replica timestamp
+    '''
+
+    def own(ts):
+        return ts[replica_id] if replica_id < len(ts) else 0
+
+    state = load_snapshot_state(snapshot_file)
+    count = own(state['replica_ts']) if state is not None else 0
+    for entry in WriteAheadLog.read():
+        if entry['op'] == 'log' and entry['record'][0] == replica_id:
+            count = max(count, own(entry['record'][1]))
+    return count
+
+
+def install_snapshot(data):
+    '''
+    Replace the data files of a replica with a snapshot received from
+    another replica manager. The files are written to a staging folder,
+    which is marked complete, before they are moved into place and the
+    write-ahead log is discarded, so a replica stopped part way through
+    is left with either its old data or, once finish_install is called,
+    the snapshot.
+
+    Params:
+        (bytes) data: snapshot encoded by encode_snapshot
+    '''
+
+    shutil.rmtree(STAGING_DIR, ignore_errors=True)
+    os.mkdir(STAGING_DIR)
+    MovieStore.write_files(data, STAGING_DIR)
+
+    with open(os.path.join(STAGING_DIR, COMPLETE_FILE), 'w') as f:
+        f.flush()
+        os.fsync(f.fileno())
+
+    finish_install()
+
+
+def finish_install():
+    '''
+    Move the files of a completely staged snapshot into place, or delete
+    those of an incomplete one. Called before a replica's data is loaded, in
+    case the replica manager was stopped while installing a snapshot.
+
+    Returns:
+        (bool) whether a snapshot was installed
+    '''
+
+    if not os.path.isdir(STAGING_DIR):
+        return False
+
+    complete = os.path.join(STAGING_DIR, COMPLETE_FILE)
+    if not os.path.exists(complete):
+        shutil.rmtree(STAGING_DIR)
+        return False
+
+    for name in os.listdir(STAGING_DIR):
+        if name != COMPLETE_FILE:
+            os.replace(os.path.join(STAGING_DIR, name), name)
+    WriteAheadLog.discard()
+
+    os.remove(complete)
+    os.rmdir(STAGING_DIR)
+    return True
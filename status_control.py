@@ -26,5 +26,11 @@ elif status == 'auto':
 elif status == 'manual':
     rm.toggle_auto_status(False)
     print(f'RM {rm_id} set to manually update status.')
+elif status == 'leave':
+    rm.leave()
+    print(f'RM {rm_id} has left the system, and can now be stopped.')
+elif status == 'metrics':
+    for name, value in rm.get_metrics().items():
+        print(f'{name}: {value}')
 else:
     print('Unrecognised status.')
@@ -0,0 +1,87 @@
+class NGramIndex:
+    '''
+    Trigram inverted index over a collection of lowercase strings, used to
+    answer substring and prefix searches without scanning every string.
+
+    Each string is padded with start and end markers before it is split into
+    trigrams, so that strings and queries shorter than three characters are
+    still covered by at least one trigram.
+    '''
+
+    START = '\x02'
+    END = '\x03'
+
+    def __init__(self):
+        self.texts = {}     # key -> indexed text
+        self.postings = {}  # trigram -> set of keys whose text contains it
+
+    def add(self, key, text):
+        '''
+        Add a string to the index.
+
+        Params:
+            key:           value returned by searches matching the string
+            (string) text: lowercase string to index
+        '''
+
+        self.texts[key] = text
+        for gram in self._trigrams(self.START + text + self.END):
+            self.postings.setdefault(gram, set()).add(key)
+
+    def search(self, query, prefix=False):
+        '''
+        Find the strings containing query.
+
+        Params:
+            (string) query: lowercase string to search for
+            (bool) prefix:  only match strings that start with query
+
+        Returns:
+            keys: set of keys of the matching strings
+        '''
+
+        if prefix:
+            query = self.START + query
+        elif not query:
+            return set(self.texts)
+
+        grams = self._trigrams(query)
+        if grams:
+            candidates = self._intersect(grams)
+        else:
+            # Query is shorter than a trigram, so take every string with a
+            # trigram containing it
+            candidates = set()
+            for gram, keys in self.postings.items():
+                if query in gram:
+                    candidates |= keys
+
+        if prefix:
+            query = query[1:]
+            return {k for k in candidates if self.texts[k].startswith(query)}
+        return {k for k in candidates if query in self.texts[k]}
+
+    def _intersect(self, grams):
+        '''
+        Intersect the posting sets of the given trigrams, smallest first.
+        '''
+
+        postings = []
+        for gram in grams:
+            keys = self.postings.get(gram)
+            if not keys:
+                return set()
+            postings.append(keys)
+
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for keys in postings[1:]:
+            candidates &= keys
+            if not candidates:
+                break
+
+        return candidates
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
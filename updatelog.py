@@ -0,0 +1,148 @@
+from bisect import bisect_right
+
+
+class UpdateLog:
+    '''
+    Update log of a replica manager, indexed by update ID and the replica
+    manager which accepted the update, so that a record received again in
+    gossip is recognised without scanning the log. An update accepted by
+    two replica managers (e.g. resent by a front end after a failure) has a
+    record from each, since both timestamps must be executed. The
+    records accepted by each replica manager are also kept in order of that
+    replica manager's entry in their timestamps, i.e. the order in which it
+    accepted them, so the records a peer has not received and the records
+    every peer has received are found by bisection.
+
+    The log is not thread safe, and must be used while holding a lock.
+    '''
+
+    def __init__(self):
+        self.records = {}   # (u_id, _id) -> record, in the order added
+        self._origins = {}  # replica ID -> [keys, records] sorted by key
+        self._updates = {}  # u_id -> number of records of the update
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(list(self.records.values()))
+
+    def get(self, key):
+        '''
+        Get the record of an update accepted by a replica manager.
+
+        Params:
+            (tuple) key: (update ID, ID of the replica manager)
+
+        Returns:
+            record: the update log record, or None if it is not in the log
+        '''
+
+        return self.records.get(key)
+
+    def has_update(self, u_id):
+        '''
+        Returns:
+            (bool) whether the log holds any record of an update
+        '''
+
+        return u_id in self._updates
+
+    def add(self, record):
+        '''
+        Add a record to the log, unless the record of the same update from
+        the same replica manager is already in it.
+
+        Params:
+            (tuple) record: update log record
+
+        Returns:
+            (bool) whether the record was added
+        '''
+
+        _id, ts, u_op, u_prev, u_id = record
+        if (u_id, _id) in self.records:
+            return False
+
+        self.records[u_id, _id] = record
+        self._updates[u_id] = self._updates.get(u_id, 0) + 1
+        keys, records = self._origins.setdefault(_id, ([], []))
+        key = ts.entry(_id)
+        if not keys or key >= keys[-1]:
+            keys.append(key)
+            records.append(record)
+        else:
+            i = bisect_right(keys, key)
+            keys.insert(i, key)
+            records.insert(i, record)
+        return True
+
+    def since(self, ts):
+        '''
+        Get the records which a replica manager with the given replica
+        timestamp has not received: those whose origin's entry is greater
+        than the entry of the timestamp.
+
+        Params:
+            (VectorClock) ts: replica timestamp of a replica manager
+
+        Returns:
+            records: list of records, in the order each origin accepted them
+        '''
+
+        recent = []
+        for _id, (keys, records) in self._origins.items():
+            recent += records[bisect_right(keys, ts.entry(_id)):]
+        return recent
+
+    def received(self, timestamps):
+        '''
+        Get the records which every one of a set of replica managers has
+        received.
+
+        Params:
+            (list) timestamps: replica timestamps (VectorClock) of the
+                               replica managers
+
+        Returns:
+            records: list of records, in the order each origin accepted them
+        '''
+
+        old = []
+        for _id, (keys, records) in self._origins.items():
+            if timestamps:
+                bound = min(ts.entry(_id) for ts in timestamps)
+                old += records[:bisect_right(keys, bound)]
+            else:
+                old += records
+        return old
+
+    def remove(self, record_keys):
+        '''
+        Remove records from the log.
+
+        Params:
+            record_keys: collection of (update ID, ID of the replica manager)
+                         of the records
+        '''
+
+        removed = set(record_keys)
+        origins = set()
+        for u_id, _id in removed:
+            del self.records[u_id, _id]
+            origins.add(_id)
+            self._updates[u_id] -= 1
+            if not self._updates[u_id]:
+                del self._updates[u_id]
+
+        # Each origin's lists are rebuilt once, rather than deleting from
+        # them record by record
+        for _id in origins:
+            keys, records = self._origins[_id]
+            kept = [i for i, record in enumerate(records)
+                    if (record[4], _id) not in removed]
+            keys[:] = [keys[i] for i in kept]
+            records[:] = [records[i] for i in kept]
@@ -1,58 +1,158 @@
+from itertools import repeat, starmap, zip_longest
+from operator import and_, eq, itemgetter, le
+
+
 class VectorClock:
+    '''
+    Vector timestamp, updated in place. Comparisons give the partial order of
+    vector timestamps: a <= b if no entry of a is greater than that of b, and
+    clocks neither of which is <= the other are concurrent.
+
+    Entry i is the count for replica manager i. Clocks grow as replica
+    managers join, and entries beyond the end of a clock are 0, so clocks of
+    different lengths can be compared and merged. A clock shared
+    between threads must only be updated while holding a lock, but may be
+    read without one: a merge replaces every entry in one step, so readers
+    never see part of a merge.
+    '''
+
+    __slots__ = ('_clock',)
+
     def __init__(self, size):
-        self.size = size
-        self._clock = tuple([0 for _ in range(size)])
+        self._clock = [0] * size
+
+    @property
+    def size(self):
+        return len(self._clock)
 
     def __eq__(self, other):
-        return self._clock == other.value()
+        if not isinstance(other, VectorClock):
+            return NotImplemented
+        if len(self._clock) == len(other._clock):
+            return all(map(eq, self._clock, other._clock))
+        return all(starmap(eq, zip_longest(self._clock, other._clock,
+                                           fillvalue=0)))
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __le__(self, other):
-        return all([i <= j for i, j in zip(self._clock, other.value())])
+        for i, j in zip(self._clock, other._clock):
+            if i > j:
+                return False
+        return not any(self._clock[len(other._clock):])
 
     def __gt__(self, other):
-        return not self.__le__(other)
+        return other.__lt__(self)
 
     def __lt__(self, other):
         return self.__le__(other) and self.__ne__(other)
 
     def __ge__(self, other):
-        return not self.__lt__(other)
+        return other.__le__(self)
+
+    __hash__ = None
 
     def __str__(self):
-        return str(self._clock)
+        return str(tuple(self._clock))
 
     def __repr__(self):
-        return str(self._clock)
+        return str(tuple(self._clock))
 
     def increment(self, index):
-        new = list(self._clock)
-        new[index] += 1
-        self._clock = tuple(new)
+        if index >= len(self._clock):
+            self._clock += [0] * (index + 1 - len(self._clock))
+        self._clock[index] += 1
 
     def merge(self, other):
-        if self.size == other.size:
-            self._clock = tuple(map(max, zip(self._clock, other.value())))
+        if len(self._clock) == len(other._clock):
+            self._clock[:] = map(max, self._clock, other._clock)
         else:
-            raise IndexError('Vector clocks are of different lengths')
+            self._clock[:] = starmap(max, zip_longest(
+                self._clock, other._clock, fillvalue=0))
+
+    def entry(self, index):
+        return self._clock[index] if index < len(self._clock) else 0
 
     def value(self):
-        return self._clock
+        return tuple(self._clock)
+
+    def freeze(self):
+        return FrozenVectorClock.fromiterable(self._clock)
 
     @staticmethod
     def concurrent(a, b):
-        return not a < b and not b < a
+        return not a <= b and not b <= a
 
     @classmethod
     def fromiterable(cls, arr):
-        new = cls(len(arr))
-        new._clock = tuple(arr)
+        new = cls.__new__(cls)
+        new._clock = list(arr)
         return new
 
     @classmethod
     def fromvectorclock(cls, vc):
-        new = cls(vc.size)
-        new.merge(vc)
+        return cls.fromiterable(vc._clock)
+
+
+class FrozenVectorClock(VectorClock):
+    '''
+    Immutable, hashable vector timestamp, for the timestamps of update log
+    records. value() returns the timestamp without copying it.
+    '''
+
+    __slots__ = ()
+
+    def __init__(self, size):
+        self._clock = (0,) * size
+
+    def __hash__(self):
+        return hash(self._clock)
+
+    def increment(self, index):
+        raise TypeError('FrozenVectorClock cannot be changed')
+
+    def merge(self, other):
+        raise TypeError('FrozenVectorClock cannot be changed')
+
+    def value(self):
+        return self._clock
+
+    def freeze(self):
+        return self
+
+    @classmethod
+    def fromiterable(cls, arr):
+        new = cls.__new__(cls)
+        new._clock = tuple(arr)
         return new
+
+
+def covered(timestamps, clock):
+    '''
+    Find which of a batch of timestamps are <= a clock. The batch is compared
+    one entry at a time, rather than one timestamp at a time, so the loops
+    run in C rather than in Python. Timestamps of different lengths are
+    padded with zeros first.
+
+    Params:
+        timestamps:          sequence of timestamps, as tuples
+        (VectorClock) clock: clock to compare the timestamps to
+
+    Returns:
+        covered: list of bools, True for each timestamp <= clock
+    '''
+
+    bounds = clock._clock
+    widths = set(map(len, timestamps))
+    width = max(widths, default=0)
+    if len(widths) > 1 or width > len(bounds):
+        timestamps = [tuple(ts) + (0,) * (width - len(ts))
+                      for ts in timestamps]
+        bounds = list(bounds) + [0] * (width - len(bounds))
+
+    result = [True] * len(timestamps)
+    for i, bound in enumerate(bounds[:width]):
+        column = map(itemgetter(i), timestamps)
+        result = list(map(and_, result, map(le, column, repeat(bound))))
+    return result